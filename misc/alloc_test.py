@@ -0,0 +1,90 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+# Reports the bytes allocated to send and to receive one message.
+# This needs CPython for tracemalloc.
+
+import tracemalloc as _tracemalloc
+
+from argon.common import *
+from argon.frames import *
+from argon.frames import _release_transfer_frame
+from argon.message import *
+
+_count = 10 * 1000
+
+def _send(buff, template, delivery_id):
+    message = Message()
+    message.id = delivery_id
+    message.to = "queue1"
+    message.durable = True
+    message.body = "x" * 32
+
+    return emit_transfer_frame(buff, 0, template, delivery_id, None, message)
+
+def _receive(buff, end):
+    offset, frame = parse_frame(buff, 0)
+    offset = end - len(frame.payload)
+
+    sections = list()
+
+    while offset < end:
+        offset, section = parse_data(buff, offset)
+        sections.append(section)
+
+    _release_transfer_frame(frame)
+
+    return sections
+
+def _measure(function, *args):
+    # Warm up the caches first
+    function(*args)
+
+    total = 0
+
+    for i in range(_count):
+        current = _tracemalloc.get_traced_memory()[0]
+        _tracemalloc.reset_peak()
+
+        function(*args)
+
+        total += _tracemalloc.get_traced_memory()[1] - current
+
+    return total / _count
+
+def _main():
+    buff = Buffer()
+    template = TransferTemplate(0, 0)
+    end = _send(buff, template, 0)
+
+    _tracemalloc.start()
+
+    sent = _measure(_send, buff, template, 1)
+    received = _measure(_receive, buff, end)
+
+    _tracemalloc.stop()
+
+    print("Allocated {:,} bytes per sent message".format(round(sent)))
+    print("Allocated {:,} bytes per received message".format(round(received)))
+
+if __name__ == "__main__":
+    try:
+        _main()
+    except KeyboardInterrupt:
+        pass
@@ -45,6 +45,11 @@ _lists = [
     [[1, 2, 3], ["a", "b", "c"]],
 ]
 
+_maps = [
+    {"a": 1, "b": 2.0, "c": "xyz"},
+    {Symbol("x-opt-a"): UnsignedInt(1), Symbol("x-opt-b"): None},
+]
+
 def _main():
     start = _time.time()
     
@@ -65,12 +70,42 @@ def _main():
     offset = 0
     
     while offset < end:
-        offset, value, descriptor = parse_data(buff, offset)
+        offset, value = parse_data(buff, offset)
 
     assert offset == end
         
     duration = _time.time() - start
     print("Decoded {:,} megabytes/second".format(round(offset / duration / (1000 * 1000), 2)))
+
+    start = _time.time()
+
+    offset = 0
+    count = 0
+
+    for i in range(100 * 1000):
+        for value in _maps:
+            offset = emit_data(buff, offset, value)
+            count += 1
+
+    duration = _time.time() - start
+    print("Encoded {:,} small maps/second".format(round(count / duration)))
+
+    array = Array(float, [x * 0.5 for x in range(1000)])
+
+    start = _time.time()
+    offset = 0
+
+    for i in range(1000):
+        offset = emit_data(buff, offset, array)
+
+    end = offset
+    offset = 0
+
+    while offset < end:
+        offset, value = parse_data(buff, offset)
+
+    duration = _time.time() - start
+    print("Encoded and decoded {:,} array elements/second".format(round(1000 * 1000 / duration)))
             
 if __name__ == "__main__":
     try:
@@ -0,0 +1,362 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+# Checks the transport against a peer on loopback, without a broker.
+# This needs CPython for threads and sendmsg.
+
+import socket as _socket
+import threading as _threading
+import time as _time
+
+import argon.transport
+
+from argon.common import *
+from argon.frames import *
+from argon.transport import *
+
+class _Peer:
+    # The other end of one transport.  It answers the protocol header
+    # and then runs function with its socket in a thread.  Once
+    # function returns, it waits for the transport to close first, so
+    # the transport never sees the connection drop.
+
+    def __init__(self, function):
+        self.function = function
+        self.result = None
+
+        self._listener = _socket.socket(_socket.AF_INET, _socket.SOCK_STREAM)
+        self._listener.bind(("127.0.0.1", 0))
+        self._listener.listen(1)
+
+        self.port = self._listener.getsockname()[1]
+
+        self._error = None
+        self._thread = _threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            sock = self._listener.accept()[0]
+            self._listener.close()
+
+            try:
+                sock.sendall(sock.recv(8, _socket.MSG_WAITALL))
+                self.result = self.function(sock)
+
+                while sock.recv(64 * 1024):
+                    pass
+            finally:
+                sock.close()
+        except Exception as e:
+            self._error = e
+
+    def join(self):
+        self._thread.join(10)
+
+        assert not self._thread.is_alive(), "The peer did not finish"
+
+        if self._error is not None:
+            raise self._error
+
+        return self.result
+
+def _emit_transfers(count, payload_size):
+    # Frames of varying size, so that reads end inside frames
+    template = TransferTemplate(0, 0)
+    buff = Buffer()
+    offset = 0
+
+    for delivery_id in range(count):
+        offset = emit_transfer_frame(buff, offset, template, delivery_id, _payload(delivery_id, payload_size))
+
+    return bytes(buff[0:offset])
+
+def _payload(delivery_id, payload_size):
+    return bytes([delivery_id % 256]) * (payload_size + delivery_id % 37)
+
+def _receive_frames(sock, count, read_size):
+    buff = Buffer()
+    end = 0
+    offset = 0
+    frames = list()
+
+    while len(frames) < count:
+        octets = sock.recv(read_size)
+        assert octets, "Connection closed"
+
+        # A slow reader keeps the sender's socket full
+        if read_size < 64 * 1024:
+            _time.sleep(0.0005)
+
+        end = buff.write(end, octets)
+
+        while end - offset >= 8 and end - offset >= buff.unpack_uint(offset):
+            offset, frame = parse_frame(buff, offset)
+            frames.append(frame)
+
+    return frames
+
+class _Receiver(TcpTransport):
+    # Stops once it has count frames, checking them as they come
+
+    def __init__(self, port, count, payload_size):
+        # A pool of its own, so the input buffer starts small
+        self.buffer_pool = BufferPool()
+
+        super().__init__("127.0.0.1", port)
+
+        self.debug = False
+        self.count = count
+        self.payload_size = payload_size
+        self.received = 0
+        self.kept_frame = None
+
+    def on_frame(self, frame):
+        assert frame.delivery_id == self.received, (frame.delivery_id, self.received)
+        assert bytes(frame.payload) == _payload(self.received, self.payload_size)
+
+        if self.kept_frame is None:
+            self.kept_frame = frame
+
+        self.received += 1
+
+        if self.received == self.count:
+            self.stop()
+
+def _check_reads():
+    # Reads grow with the input buffer, so a burst of frames comes in
+    # far fewer reads than frames
+    count = 2000
+    octets = _emit_transfers(count, 16)
+    peer = _Peer(lambda sock: sock.sendall(octets))
+
+    transport = _Receiver(peer.port, count, 16)
+    transport.run()
+    peer.join()
+
+    stats = transport.stats()
+
+    assert transport.received == count
+    assert stats["reads_per_frame"] < 0.5, stats
+
+    # Frames kept past on_frame keep their fast-path fields, but their
+    # performative is gone with the input buffer
+    frame = transport.kept_frame
+    assert frame.delivery_id == 0
+
+    try:
+        frame.performative
+    except Exception as e:
+        assert "not available" in str(e), e
+    else:
+        assert False, "Expected an error"
+
+def _check_compaction():
+    # Small reads of a steady stream leave a partial frame at the end
+    # of the input buffer.  It is moved to the front instead of letting
+    # the buffer grow, and no frame is damaged by the move.
+    count = 3000
+    octets = _emit_transfers(count, 100)
+    peer = _Peer(lambda sock: sock.sendall(octets))
+
+    transport = _Receiver(peer.port, count, 100)
+    transport.read_size = 256
+    transport.drain_reads = True
+    transport.max_drain_size = 1024
+    transport.run()
+    peer.join()
+
+    assert transport.received == count
+    assert transport.compact_count > 0, transport.stats()
+
+class _Sender(TcpTransport):
+    # Sends count transfers, each with a payload of payload_size or
+    # more, and stops on the peer's reply
+
+    def __init__(self, port, count, payload_size):
+        super().__init__("127.0.0.1", port)
+
+        # Debug output turns off segments
+        self.debug = False
+        self.count = count
+        self.payload_size = payload_size
+        self.start_time = None
+
+    def on_start(self):
+        template = TransferTemplate(0, 0)
+        self.start_time = _time.monotonic()
+
+        for delivery_id in range(self.count):
+            self.emit_transfer_frame(template, delivery_id, _payload(delivery_id, self.payload_size))
+
+    def on_frame(self, frame):
+        self.stop()
+
+def _reply_after(count, read_size=64 * 1024):
+    # Receives count frames, replies with a close, and returns the
+    # frames and the time the first octets came in
+    def function(sock):
+        sock.settimeout(10)
+
+        first_octets = sock.recv(1, _socket.MSG_PEEK)
+        first_time = _time.monotonic()
+        assert first_octets
+
+        frames = _receive_frames(sock, count, read_size)
+
+        buff = Buffer()
+        end = emit_amqp_frame(buff, 0, 0, ClosePerformative())
+        sock.sendall(bytes(buff[0:end]))
+
+        return frames, first_time
+
+    return function
+
+def _check_frames(frames, count, payload_size):
+    assert len(frames) == count, len(frames)
+
+    for delivery_id, frame in enumerate(frames):
+        assert frame.delivery_id == delivery_id
+        assert bytes(frame.payload) == _payload(delivery_id, payload_size)
+
+def _check_segments():
+    # Payloads over segment_size are sent from the caller's octets.  A
+    # small send buffer forces partial sends that end inside segments,
+    # and the part cap splits the gather across several sends.
+    count = 100
+    payload_size = 32 * 1024
+    peer = _Peer(_reply_after(count, 4096))
+
+    transport = _Sender(peer.port, count, payload_size)
+    transport.segment_size = 1024
+    transport.socket.setsockopt(_socket.SOL_SOCKET, _socket.SO_SNDBUF, 8 * 1024)
+
+    max_write_parts = argon.transport._max_write_parts
+    argon.transport._max_write_parts = 6
+
+    try:
+        transport.run()
+    finally:
+        argon.transport._max_write_parts = max_write_parts
+
+    frames, first_time = peer.join()
+
+    _check_frames(frames, count, payload_size)
+    assert not transport._output_segments
+
+def _check_flush():
+    # Output is held for flush_delay milliseconds
+    flush_delay = 100
+    peer = _Peer(_reply_after(3))
+
+    transport = _Sender(peer.port, 3, 16)
+    transport.flush_delay = flush_delay
+    transport.run()
+
+    frames, first_time = peer.join()
+
+    _check_frames(frames, 3, 16)
+    assert first_time - transport.start_time >= (flush_delay - 2) / 1000, first_time - transport.start_time
+
+    # Reaching flush_size sends at once
+    peer = _Peer(_reply_after(3))
+
+    transport = _Sender(peer.port, 3, 16)
+    transport.flush_delay = 10 * 1000
+    transport.flush_size = 16
+    transport.run()
+
+    frames, first_time = peer.join()
+
+    _check_frames(frames, 3, 16)
+    assert first_time - transport.start_time < 5, first_time - transport.start_time
+
+class _CorkedSender(_Sender):
+    # Holds its output until the reactor runs the uncork timer
+
+    def __init__(self, port, count, payload_size, reactor):
+        super().__init__(port, count, payload_size)
+
+        self.reactor = reactor
+        self.uncork_time = None
+
+    def on_start(self):
+        self.cork()
+
+        super().on_start()
+
+        self.reactor.schedule(100, self._uncork)
+
+    def _uncork(self):
+        self.uncork_time = _time.monotonic()
+        self.uncork()
+
+def _check_reactor():
+    # Several transports on one reactor, one of them corked until a
+    # timer fires
+    reactor = Reactor()
+    count = 50
+    peers = list()
+    transports = list()
+
+    for i in range(4):
+        peer = _Peer(_reply_after(count))
+
+        if i == 0:
+            transport = _CorkedSender(peer.port, count, 16, reactor)
+        else:
+            transport = _Sender(peer.port, count, 16)
+
+        peers.append(peer)
+        transports.append(transport)
+
+        reactor.add(transport)
+
+    timer_times = list()
+    reactor.schedule(50, lambda: timer_times.append(_time.monotonic()))
+
+    reactor.run()
+
+    for peer in peers:
+        frames, first_time = peer.join()
+        _check_frames(frames, count, 16)
+
+    assert len(timer_times) == 1
+
+    corked = transports[0]
+    first_time = peers[0].result[1]
+
+    assert corked.uncork_time is not None
+    assert first_time >= corked.uncork_time, (first_time, corked.uncork_time)
+
+    for transport in transports:
+        assert transport._reactor is None
+        assert transport._input_buffer is None
+
+def _main():
+    _check_reads()
+    _check_compaction()
+    _check_segments()
+    _check_flush()
+    _check_reactor()
+
+    print("OK")
+
+if __name__ == "__main__":
+    _main()
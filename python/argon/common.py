@@ -23,6 +23,9 @@ _micropython = _sys.implementation.name == "micropython"
 
 if _micropython:
     import gc as _gc
+    import uarray as _array
+    from ucollections import OrderedDict as _OrderedDict
+    import uheapq as _heapq
     import uos as _os
     import urandom as _random
     import uselect as _select
@@ -31,11 +34,16 @@ if _micropython:
     import utime as _time
 else:
     _gc = None
+    _OrderedDict = dict
+    _threading = None
+    import array as _array
+    import heapq as _heapq
     import os as _os
     import random as _random
     import select as _select
     import socket as _socket
     import struct as _struct
+    import threading as _threading
     import time as _time
 
 try:
@@ -43,9 +51,50 @@ try:
 except AttributeError:
     _DEBUG = False
 
+if _micropython:
+    class _Struct:
+        def __init__(self, format_string):
+            self.format = format_string
+            self.size = _struct.calcsize(format_string)
+
+        def pack_into(self, buff, offset, *values):
+            _struct.pack_into(self.format, buff, offset, *values)
+
+        def unpack_from(self, buff, offset=0):
+            return _struct.unpack_from(self.format, buff, offset)
+else:
+    _Struct = _struct.Struct
+
+_structs_by_format_string = dict()
+
+def _get_struct(format_string):
+    try:
+        return _structs_by_format_string[format_string]
+    except KeyError:
+        struct = _structs_by_format_string[format_string] = _Struct(format_string)
+        return struct
+
+_byte_struct = _Struct("!b")
+_ushort_struct = _Struct("!H")
+_short_struct = _Struct("!h")
+_uint_struct = _Struct("!I")
+_int_struct = _Struct("!i")
+_ulong_struct = _Struct("!Q")
+_long_struct = _Struct("!q")
+_float_struct = _Struct("!f")
+_double_struct = _Struct("!d")
+
 class Buffer:
-    def __init__(self):
-        self._octets = bytearray(256)
+    """
+    A growable octet buffer.  Capacity doubles as needed.  If
+    shrink_size is set, shrink() gives back any capacity above it
+    once the used part fits below it again.
+    """
+
+    def __init__(self, size=256, shrink_size=None):
+        self.shrink_size = shrink_size
+
+        self._octets = bytearray(size)
         self._view = memoryview(self._octets)
 
     def skip(self, offset, size):
@@ -63,13 +112,69 @@ class Buffer:
 
         return end
 
-    def unpack(self, offset, size, format_string):
-        assert len(self) > offset + size
+    # The source and destination ranges of move() may overlap
 
-        values = _struct.unpack_from(format_string, self._view, offset)
+    if _micropython:
+        def move(self, start, end, offset):
+            new_end = offset + (end - start)
 
+            self.ensure(new_end)
+
+            # MicroPython stores slices with memcpy, which is undefined
+            # for overlapping ranges, so the octets go through a copy
+            self._view[offset:new_end] = bytes(self._view[start:end])
+
+            return new_end
+    else:
+        def move(self, start, end, offset):
+            new_end = offset + (end - start)
+
+            self.ensure(new_end)
+            self._view[offset:new_end] = self._view[start:end]
+
+            return new_end
+
+    def unpack(self, offset, size, format_string):
+        values = _get_struct(format_string).unpack_from(self._view, offset)
         return (offset + size,) + values
 
+    def unpack_array(self, offset, size, count, typecode):
+        values = _struct.unpack_from("!{}{}".format(count, typecode), self._view, offset)
+        return offset + size, values
+
+    # The single-value unpack methods return only the value.  The
+    # caller advances the offset by the size of the type.
+
+    def unpack_ubyte(self, offset):
+        return self._view[offset]
+
+    def unpack_byte(self, offset):
+        return _byte_struct.unpack_from(self._view, offset)[0]
+
+    def unpack_ushort(self, offset):
+        return _ushort_struct.unpack_from(self._view, offset)[0]
+
+    def unpack_short(self, offset):
+        return _short_struct.unpack_from(self._view, offset)[0]
+
+    def unpack_uint(self, offset):
+        return _uint_struct.unpack_from(self._view, offset)[0]
+
+    def unpack_int(self, offset):
+        return _int_struct.unpack_from(self._view, offset)[0]
+
+    def unpack_ulong(self, offset):
+        return _ulong_struct.unpack_from(self._view, offset)[0]
+
+    def unpack_long(self, offset):
+        return _long_struct.unpack_from(self._view, offset)[0]
+
+    def unpack_float(self, offset):
+        return _float_struct.unpack_from(self._view, offset)[0]
+
+    def unpack_double(self, offset):
+        return _double_struct.unpack_from(self._view, offset)[0]
+
     def __getitem__(self, index):
         return self._view[index]
 
@@ -81,18 +186,214 @@ class Buffer:
 
     def ensure(self, size):
         if len(self._octets) < size:
-            new_size = max(size, 2 * len(self._octets))
+            self._resize(max(size, 2 * len(self._octets)))
+
+    def shrink(self, used):
+        if self.shrink_size is None:
+            return
+
+        if used <= self.shrink_size < len(self._octets):
+            self._resize(self.shrink_size)
+
+    def compact(self, start, end):
+        # Move the octets from start to end to the front.  Returns
+        # the new end.
+        if start == 0:
+            return end
+
+        return self.move(start, end, 0)
+
+    if _micropython:
+        def _resize(self, new_size):
+            old_size = len(self._octets)
+
+            # MicroPython memoryviews point directly at the octets, so
+            # resizing in place would leave outstanding views dangling
+            if new_size > old_size:
+                self._octets = self._octets + bytearray(new_size - old_size)
+            else:
+                self._octets = self._octets[:new_size]
+
+            self._view = memoryview(self._octets)
+    else:
+        def _resize(self, new_size):
+            old_size = len(self._octets)
+
+            self._view.release()
+
+            try:
+                # Resize in place when no views of the old octets
+                # are still alive
+                if new_size > old_size:
+                    self._octets.extend(bytes(new_size - old_size))
+                else:
+                    del self._octets[new_size:]
+            except BufferError:
+                octets = bytearray(new_size)
+                size = min(old_size, new_size)
+                octets[:size] = self._octets[:size]
+                self._octets = octets
 
-            self._octets = self._octets + bytearray(new_size - len(self._octets))
             self._view = memoryview(self._octets)
 
     def pack(self, offset, size, format_string, *values):
         self.ensure(offset + size)
 
-        _struct.pack_into(format_string, self._octets, offset, *values)
+        _get_struct(format_string).pack_into(self._octets, offset, *values)
 
         return offset + size
 
+    def pack_array(self, offset, size, typecode, values):
+        self.ensure(offset + size)
+
+        _struct.pack_into("!{}{}".format(len(values), typecode), self._octets, offset, *values)
+
+        return offset + size
+
+    def pack_ubyte(self, offset, value):
+        self.ensure(offset + 1)
+        self._octets[offset] = value
+        return offset + 1
+
+    def pack_byte(self, offset, value):
+        self.ensure(offset + 1)
+        _byte_struct.pack_into(self._octets, offset, value)
+        return offset + 1
+
+    def pack_uint(self, offset, value):
+        self.ensure(offset + 4)
+        _uint_struct.pack_into(self._octets, offset, value)
+        return offset + 4
+
+class BufferPool:
+    """
+    A free list of Buffers, kept by power-of-two size class.  Use
+    checkout() to borrow a buffer and checkin() to hand it back.
+    Buffers outside min_size and max_size, or returned when their
+    class already holds max_free buffers, are left to the collector.
+    """
+
+    def __init__(self, min_size=256, max_size=1024 * 1024, max_free=16):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_free = max_free
+
+        self.checkouts = 0
+        self.checkins = 0
+        self.hits = 0
+        self.misses = 0
+        self.discards = 0
+
+        self._free_buffers_by_size = dict()
+
+        size = min_size
+
+        while size <= max_size:
+            self._free_buffers_by_size[size] = list()
+            size *= 2
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, ", ".join("{}={}".format(*x) for x in self.stats().items()))
+
+    def checkout(self, size=0, shrink_size=None):
+        self.checkouts += 1
+
+        class_size = self.min_size
+
+        while class_size < size:
+            class_size *= 2
+
+        try:
+            buff = self._free_buffers_by_size[class_size].pop()
+        except (KeyError, IndexError):
+            self.misses += 1
+            buff = Buffer(class_size)
+        else:
+            self.hits += 1
+
+        buff.shrink_size = shrink_size
+
+        return buff
+
+    def checkin(self, buff):
+        self.checkins += 1
+
+        # The largest class the buffer can still serve
+        size = len(buff)
+        class_size = self.min_size
+
+        while class_size * 2 <= size:
+            class_size *= 2
+
+        try:
+            free_buffers = self._free_buffers_by_size[class_size]
+        except KeyError:
+            free_buffers = None
+
+        if size < self.min_size or free_buffers is None or len(free_buffers) >= self.max_free:
+            self.discards += 1
+            return
+
+        free_buffers.append(buff)
+
+    def stats(self):
+        return {
+            "checkouts": self.checkouts,
+            "checkins": self.checkins,
+            "hits": self.hits,
+            "misses": self.misses,
+            "discards": self.discards,
+            "free": sum(len(x) for x in self._free_buffers_by_size.values()),
+        }
+
+class _LruCache:
+    # A hit moves the entry to the end by popping and reinserting it,
+    # so the first entry is always the least recently used.  The caches
+    # of the data types are shared by all threads, so an entry can be
+    # popped or evicted by another thread at any point.  That costs a
+    # miss, never an error.
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._items = _OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        items = self._items
+
+        try:
+            value = items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        items[key] = value
+        self.hits += 1
+
+        return value
+
+    def put(self, key, value):
+        items = self._items
+
+        if len(items) >= self.max_size:
+            if not self.max_size:
+                return
+
+            try:
+                items.pop(next(iter(items)), None)
+            except (RuntimeError, StopIteration):
+                pass
+
+        items[key] = value
+
+    def clear(self):
+        self._items.clear()
+
 def _uuid_bytes():
     _random.seed(round(_time.time() * 1000))
 
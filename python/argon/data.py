@@ -18,7 +18,29 @@
 #
 
 from argon.common import *
-from argon.common import _hex, _micropython, _struct
+from argon.common import _LruCache, _array, _hex, _micropython, _struct, _sys, _threading
+
+try:
+    import numpy as _numpy
+except ImportError:
+    _numpy = None
+
+# Struct and array.array typecodes for numeric array elements, and
+# the matching NumPy types
+_array_typecodes = "bBhHiIqQfd"
+
+_numpy_dtypes = {
+    "b": "i1",
+    "B": "u1",
+    "h": "i2",
+    "H": "u2",
+    "i": "i4",
+    "I": "u4",
+    "q": "i8",
+    "Q": "u8",
+    "f": "f4",
+    "d": "f8",
+}
 
 class UnsignedByte(int): pass
 class UnsignedShort(int): pass
@@ -48,50 +70,130 @@ class Array:
     def __repr__(self):
         return "{}({}, {})".format(self.__class__.__name__, self.element_type, self.elements)
 
+# Type hints for fields and described values.  Elements, keys, and
+# values of the declared type, or of its plain Python base type, are
+# encoded as that type, so plain ints and strings need no wrappers.
+
+class TypedList:
+    def __init__(self, element_type):
+        self.element_type = element_type
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, self.element_type)
+
+class TypedMap:
+    def __init__(self, key_type, value_type=None):
+        self.key_type = key_type
+        self.value_type = value_type
+
+    def __repr__(self):
+        return "{}({}, {})".format(self.__class__.__name__, self.key_type, self.value_type)
+
 class DescribedValue:
-    __slots__ = "_descriptor", "_value"
+    __slots__ = "_descriptor", "_value", "_encoded"
+
+    # Subclasses set this to keep their encoded octets after the first
+    # emit.  The cache is cleared when a field is set, so the value must
+    # only be changed through its fields.
+    _cache_encoding = False
+
+    # A type hint for the value as a whole, such as TypedMap(Symbol)
+    _value_type = None
+
+    # Described lists with declared fields get this many slots when
+    # the first field is set.  It is filled in by
+    # _compile_described_list.
+    _field_count = 0
 
     def __init__(self, descriptor, value):
         self._descriptor = descriptor
         self._value = value
+        self._encoded = None
 
     def __repr__(self):
-        return "<{}>{}".format(self._descriptor, self._value)
+        value = self._value
+
+        if self._field_count:
+            value = _trim_fields(value)
+
+        return "<{}>{}".format(self._descriptor, value)
 
     def __eq__(self, other):
-        if other is None:
+        if other is None or self._descriptor != other._descriptor:
             return False
 
-        return (self._descriptor, self._value) == (other._descriptor, other._value)
+        if self._field_count or other._field_count:
+            return _trim_fields(self._value) == _trim_fields(other._value)
+
+        return self._value == other._value
+
+# Unset fields at the end of the field list of a class with declared
+# fields are not significant.  In other described lists they are.
+def _trim_fields(value):
+    if type(value) is not list or len(value) == 0 or value[-1] is not None:
+        return value
+
+    count = len(value)
+
+    while count and value[count - 1] is None:
+        count -= 1
+
+    return value[:count]
+
+# Field metadata for _compile_described_list, keyed by property
+_field_specs_by_property = dict()
+
+def _field(index, mandatory=False, default=None, type_=None):
+    # A null field reads as the default.  Setting the default stores
+    # null, so it is not encoded.
 
-def _field(index, mandatory=False, default=None):
     def get(obj):
-        if obj._value is None:
+        values = obj._value
+
+        if values is None or index >= len(values):
             return default
 
-        try:
-            return obj._value[index]
-        except IndexError:
+        value = values[index]
+
+        if value is None:
             return default
 
+        return value
+
     def set_(obj, value):
         assert not mandatory or value is not None
 
         if value == default:
-            return
+            value = None
 
-        if obj._value is None:
-            obj._value = list()
+        values = obj._value
 
-        try:
-            obj._value[index] = value
-        except IndexError:
-            if value is not None:
-                obj._value += ([None] * (index - len(obj._value))) + [value]
+        if values is None:
+            values = obj._value = [None] * obj._field_count
+
+        if index >= len(values):
+            if value is None:
+                return
+
+            values.extend([None] * (index + 1 - len(values)))
+
+        values[index] = value
+        obj._encoded = None
 
-    return property(get, set_)
+    prop = property(get, set_)
+    _field_specs_by_property[prop] = index, type_
+
+    return prop
 
 class _DataType:
+    # Set for fixed-width numeric types whose array elements can be
+    # packed and unpacked with a single struct call
+    array_typecode = None
+
+    # Set for types whose short values tend to repeat, such as map
+    # keys and annotation names.  See emit_cached.
+    encoded_cache = None
+
     def __init__(self, python_type, format_code):
         assert python_type is not None
         assert format_code is not None
@@ -114,14 +216,14 @@ class _DataType:
         offset, format_code_offset = self.emit_constructor(buff, offset, descriptor)
         offset, format_code = self.emit_value(buff, offset, value)
 
-        buff.pack(format_code_offset, 1, "!B", format_code)
+        buff.pack_ubyte(format_code_offset, format_code)
 
         return offset
 
     def emit_constructor(self, buff, offset, descriptor):
         if descriptor is not None:
-            offset = buff.pack(offset, 1, "!B", 0x00)
-            offset = emit_data(buff, offset, descriptor)
+            offset = buff.pack_ubyte(offset, 0x00)
+            offset = _emit_descriptor(buff, offset, descriptor)
 
         # The format code is filled in after the value is emitted
         offset, format_code_offset = buff.skip(offset, 1)
@@ -141,9 +243,6 @@ class _NullType(_DataType):
     def emit_value_long(self, buff, offset, value):
         return offset, self.format_code
 
-    def parse_value(self, buff, offset, format_code):
-        return offset, None
-
 class _BooleanType(_DataType):
     def __init__(self):
         super().__init__(bool, 0x56)
@@ -155,19 +254,11 @@ class _BooleanType(_DataType):
         raise Exception()
 
     def emit_value_long(self, buff, offset, value):
-        if value is True: return buff.pack(offset, 1, "!B", 0x01), self.format_code
-        if value is False: return buff.pack(offset, 1, "!B", 0x00), self.format_code
+        if value is True: return buff.pack_ubyte(offset, 0x01), self.format_code
+        if value is False: return buff.pack_ubyte(offset, 0x00), self.format_code
 
         raise Exception()
 
-    def parse_value(self, buff, offset, format_code):
-        if format_code == 0x41: return offset, True
-        if format_code == 0x42: return offset, False
-
-        offset, value = buff.unpack(offset, 1, "!B")
-
-        return offset, value == 0x01
-
 class _FixedWidthType(_DataType):
     def __init__(self, python_type, format_code, format_string):
         super().__init__(python_type, format_code)
@@ -175,19 +266,14 @@ class _FixedWidthType(_DataType):
         self.format_string = format_string
         self.format_size = _struct.calcsize(self.format_string)
 
+        if format_string[1:] in _array_typecodes:
+            self.array_typecode = format_string[1:]
+
     def emit_value_long(self, buff, offset, value):
         offset = buff.pack(offset, self.format_size, self.format_string, value)
         return offset, self.format_code
 
-    def parse_value(self, buff, offset, format_code):
-        return buff.unpack(offset, self.format_size, self.format_string)
-
-class _WrappedFixedWidthType(_FixedWidthType):
-    def parse_value(self, buff, offset, format_code):
-        offset, value = super().parse_value(buff, offset, format_code)
-        return offset, self.python_type(value)
-
-class _UnsignedByteType(_WrappedFixedWidthType):
+class _UnsignedByteType(_FixedWidthType):
     def __init__(self):
         super().__init__(UnsignedByte, 0x50, "!B")
 
@@ -196,7 +282,7 @@ class _UnsignedByteType(_WrappedFixedWidthType):
             value = int.from_bytes(value.to_bytes(1, "big"), "big")
             return self.emit_value_long(buff, offset, value)
 
-class _UnsignedShortType(_WrappedFixedWidthType):
+class _UnsignedShortType(_FixedWidthType):
     def __init__(self):
         super().__init__(UnsignedShort, 0x60, "!H")
 
@@ -205,7 +291,7 @@ class _UnsignedShortType(_WrappedFixedWidthType):
             value = int.from_bytes(value.to_bytes(2, "big"), "big")
             return self.emit_value_long(buff, offset, value)
 
-class _UnsignedIntType(_WrappedFixedWidthType):
+class _UnsignedIntType(_FixedWidthType):
     def __init__(self):
         super().__init__(UnsignedInt, 0x70, "!I")
 
@@ -214,17 +300,11 @@ class _UnsignedIntType(_WrappedFixedWidthType):
             value = int.from_bytes(value.to_bytes(4, "big"), "big")
 
         if value == 0: return offset, 0x43
-        if value < 256: return buff.pack(offset, 1, "!B", value), 0x52
+        if value < 256: return buff.pack_ubyte(offset, value), 0x52
 
         return self.emit_value_long(buff, offset, value)
 
-    def parse_value(self, buff, offset, format_code):
-        if format_code == 0x43: return offset, 0
-        if format_code == 0x52: return buff.unpack(offset, 1, "!B")
-
-        return super().parse_value(buff, offset, format_code)
-
-class _UnsignedLongType(_WrappedFixedWidthType):
+class _UnsignedLongType(_FixedWidthType):
     def __init__(self):
         super().__init__(UnsignedLong, 0x80, "!Q")
 
@@ -233,54 +313,38 @@ class _UnsignedLongType(_WrappedFixedWidthType):
             value = int.from_bytes(value.to_bytes(8, "big"), "big")
 
         if value == 0: return offset, 0x44
-        if value < 256: return buff.pack(offset, 1, "!B", value), 0x53
+        if value < 256: return buff.pack_ubyte(offset, value), 0x53
 
         return self.emit_value_long(buff, offset, value)
 
-    def parse_value(self, buff, offset, format_code):
-        if format_code == 0x44: return offset, 0
-        if format_code == 0x53: return buff.unpack(offset, 1, "!B")
-
-        return super().parse_value(buff, offset, format_code)
-
-class _ByteType(_WrappedFixedWidthType):
+class _ByteType(_FixedWidthType):
     def __init__(self):
         super().__init__(Byte, 0x51, "!b")
 
-class _ShortType(_WrappedFixedWidthType):
+class _ShortType(_FixedWidthType):
     def __init__(self):
         super().__init__(Short, 0x61, "!h")
 
-class _IntType(_WrappedFixedWidthType):
+class _IntType(_FixedWidthType):
     def __init__(self):
         super().__init__(Int, 0x71, "!i")
 
     def emit_value(self, buff, offset, value):
-        if value >= -128 and value <= 127: return buff.pack(offset, 1, "!b", value), 0x54
+        if value >= -128 and value <= 127: return buff.pack_byte(offset, value), 0x54
 
         return self.emit_value_long(buff, offset, value)
 
-    def parse_value(self, buff, offset, format_code):
-        if format_code == 0x54: return buff.unpack(offset, 1, "!b")
-
-        return super().parse_value(buff, offset, format_code)
-
 class _LongType(_FixedWidthType):
     def __init__(self):
         super().__init__(int, 0x81, "!q")
 
     def emit_value(self, buff, offset, value):
         if value >= -128 and value <= 127:
-            return buff.pack(offset, 1, "!b", value), 0x55
+            return buff.pack_byte(offset, value), 0x55
 
         return self.emit_value_long(buff, offset, value)
 
-    def parse_value(self, buff, offset, format_code):
-        if format_code == 0x55: return buff.unpack(offset, 1, "!b")
-
-        return super().parse_value(buff, offset, format_code)
-
-class _FloatType(_WrappedFixedWidthType):
+class _FloatType(_FixedWidthType):
     def __init__(self):
         super().__init__(Float, 0x72, "!f")
 
@@ -288,15 +352,15 @@ class _DoubleType(_FixedWidthType):
     def __init__(self):
         super().__init__(float, 0x82, "!d")
 
-class _Decimal32Type(_WrappedFixedWidthType):
+class _Decimal32Type(_FixedWidthType):
     def __init__(self):
         super().__init__(Decimal32, 0x74, "!4s")
 
-class _Decimal64Type(_WrappedFixedWidthType):
+class _Decimal64Type(_FixedWidthType):
     def __init__(self):
         super().__init__(Decimal64, 0x84, "!8s")
 
-class _Decimal128Type(_WrappedFixedWidthType):
+class _Decimal128Type(_FixedWidthType):
     def __init__(self):
         super().__init__(Decimal128, 0x94, "!16s")
 
@@ -308,11 +372,7 @@ class _CharType(_FixedWidthType):
         value = value.encode("utf-32-be")
         return super().emit_value_long(buff, offset, value)
 
-    def parse_value(self, buff, offset, format_code):
-        offset, value = super().parse_value(buff, offset, format_code)
-        return offset, self.python_type(value.decode("utf-32-be"))
-
-class _UuidType(_WrappedFixedWidthType):
+class _UuidType(_FixedWidthType):
     def __init__(self):
         super().__init__(Uuid, 0x98, "!16s")
 
@@ -320,14 +380,13 @@ class _TimestampType(_FixedWidthType):
     def __init__(self):
         super().__init__(Timestamp, 0x83, "!q")
 
+        # Values are converted to and from milliseconds one at a time
+        self.array_typecode = None
+
     def emit_value_long(self, buff, offset, value):
         value = int(round(value * 1000))
         return super().emit_value_long(buff, offset, value)
 
-    def parse_value(self, buff, offset, format_code):
-        offset, value = super().parse_value(buff, offset, format_code)
-        return offset, self.python_type(round(value / 1000, 3))
-
 class _VariableWidthType(_DataType):
     def __init__(self, python_type, short_format_code, long_format_code):
         super().__init__(python_type, long_format_code)
@@ -338,8 +397,24 @@ class _VariableWidthType(_DataType):
     def encode(self, value):
         raise NotImplementedError()
 
-    def decode(self, octets):
-        raise NotImplementedError()
+    def emit_cached(self, buff, offset, value):
+        # Emits the constructor and value.  Values shorter than
+        # cached_length are kept in encoded_cache with their
+        # constructor already encoded.
+        if len(value) < self.cached_length:
+            octets = self.encoded_cache.get(value)
+
+            if octets is not None:
+                return buff.write(offset, octets)
+
+        start = offset
+        offset, format_code = self.emit_value(buff, offset + 1, value)
+        buff.pack_ubyte(start, format_code)
+
+        if len(value) < self.cached_length:
+            self.encoded_cache.put(value, bytes(buff[start:offset]))
+
+        return offset
 
     def emit_value(self, buff, offset, value):
         if len(value) < 256:
@@ -350,7 +425,7 @@ class _VariableWidthType(_DataType):
     def emit_value_short(self, buff, offset, value):
         octets = self.encode(value)
 
-        offset = buff.pack(offset, 1, "!B", len(octets))
+        offset = buff.pack_ubyte(offset, len(octets))
         offset = buff.write(offset, octets)
 
         return offset, self.short_format_code
@@ -358,24 +433,11 @@ class _VariableWidthType(_DataType):
     def emit_value_long(self, buff, offset, value):
         octets = self.encode(value)
 
-        offset = buff.pack(offset, 4, "!I", len(octets))
+        offset = buff.pack_uint(offset, len(octets))
         offset = buff.write(offset, octets)
 
         return offset, self.long_format_code
 
-    def parse_value(self, buff, offset, format_code):
-        assert format_code in (self.short_format_code, self.long_format_code)
-
-        if format_code == self.short_format_code:
-            offset, size = buff.unpack(offset, 1, "!B")
-        else:
-            offset, size = buff.unpack(offset, 4, "!I")
-
-        offset, octets = buff.read(offset, size)
-        value = self.decode(octets)
-
-        return offset, value
-
 class _BinaryType(_VariableWidthType):
     def __init__(self):
         super().__init__(bytes, 0xa0, 0xb0)
@@ -383,19 +445,17 @@ class _BinaryType(_VariableWidthType):
     def encode(self, value):
         return value
 
-    def decode(self, octets):
-        return bytes(octets)
-
 class _StringType(_VariableWidthType):
+    cached_length = 64
+
     def __init__(self):
         super().__init__(str, 0xa1, 0xb1)
 
+        self.encoded_cache = _LruCache(256)
+
     def encode(self, value):
         return value.encode("utf-8")
 
-    def decode(self, octets):
-        return bytes(octets).decode("utf-8")
-
     def emit_value(self, buff, offset, value):
         if len(value) < 64:
             return self.emit_value_short(buff, offset, value)
@@ -403,15 +463,16 @@ class _StringType(_VariableWidthType):
         return self.emit_value_long(buff, offset, value)
 
 class _SymbolType(_VariableWidthType):
+    cached_length = 64
+
     def __init__(self):
         super().__init__(Symbol, 0xa3, 0xb3)
 
+        self.encoded_cache = _LruCache(256)
+
     def encode(self, value):
         return value.encode("ascii")
 
-    def decode(self, octets):
-        return Symbol(bytes(octets).decode("ascii"))
-
 class _CollectionType(_DataType):
     def __init__(self, python_type, short_format_code, long_format_code):
         super().__init__(python_type, long_format_code)
@@ -419,17 +480,6 @@ class _CollectionType(_DataType):
         self.short_format_code = short_format_code
         self.long_format_code = long_format_code
 
-    def parse_size_and_count(self, buff, offset, format_code):
-        assert format_code in (self.short_format_code, self.long_format_code)
-
-        if format_code == self.short_format_code:
-            return buff.unpack(offset, 2, "!BB")
-
-        if format_code == self.long_format_code:
-            return buff.unpack(offset, 8, "!II")
-
-        raise Exception()
-
 class _CompoundType(_CollectionType):
     def __init__(self, python_type, short_format_code, long_format_code):
         super().__init__(python_type, short_format_code, long_format_code)
@@ -449,21 +499,21 @@ class _CompoundType(_CollectionType):
         size = offset - count_offset
 
         if size >= 256:
-            encoded_value = bytes(buff[value_offset:offset])
-            return self.emit_value_long(buff, size_offset, value, encoded_value)
+            # Widen the size and count fields in place
+            offset = buff.move(value_offset, offset, value_offset + 6)
+            buff.pack(size_offset, 8, "!II", size + 3, count)
+
+            return offset, self.long_format_code
 
         buff.pack(size_offset, 2, "!BB", size, count)
 
         return offset, self.short_format_code
 
-    def emit_value_long(self, buff, offset, value, encoded_value=None):
+    def emit_value_long(self, buff, offset, value):
         offset, size_offset = buff.skip(offset, 4)
         offset, count_offset = buff.skip(offset, 4)
 
-        if encoded_value is None:
-            offset = self.encode_into(buff, offset, value)
-        else:
-            offset = buff.write(offset, encoded_value)
+        offset = self.encode_into(buff, offset, value)
 
         size = offset - count_offset
         count = self.get_count(value)
@@ -472,12 +522,6 @@ class _CompoundType(_CollectionType):
 
         return offset, self.long_format_code
 
-    def parse_value(self, buff, offset, format_code):
-        offset, size, count = self.parse_size_and_count(buff, offset, format_code)
-        offset, value = self.decode_from(buff, offset, count)
-
-        return offset, value
-
 class _ListType(_CompoundType):
     def __init__(self):
         super().__init__(list, 0xc0, 0xd0)
@@ -491,29 +535,11 @@ class _ListType(_CompoundType):
 
         return offset
 
-    def decode_from(self, buff, offset, count):
-        # assert count < 1000, count # This is incorrect, but it catches some codec bugs
-
-        value = [None] * count
-
-        for i in range(count):
-            offset, value[i] = parse_data(buff, offset)
-
-        return offset, value
-
     def emit_value(self, buff, offset, value):
         if len(value) == 0: return offset, 0x45
 
         return super().emit_value(buff, offset, value)
 
-    def parse_value(self, buff, offset, format_code):
-        if format_code == 0x45:
-            value = list()
-        else:
-            offset, value = super().parse_value(buff, offset, format_code)
-
-        return offset, value
-
 class _MapType(_CompoundType):
     def __init__(self):
         super().__init__(dict, 0xc1, 0xd1)
@@ -528,43 +554,29 @@ class _MapType(_CompoundType):
 
         return offset
 
-    def decode_from(self, buff, offset, count):
-        items = dict()
-
-        for i in range(0, count, 2):
-            offset, item_key = parse_data(buff, offset)
-            offset, item_value = parse_data(buff, offset)
-
-            items[item_key] = item_value
-
-        return offset, items
-
 class _ArrayType(_CollectionType):
     def __init__(self):
         super().__init__(Array, 0xf0, 0xe0)
 
     def encode_into(self, buff, offset, value):
         elem_type = _get_data_type_for_python_type(value.element_type)
+        elems = value.elements
 
-        for elem in value.elements:
+        if elem_type.array_typecode is not None:
+            size = len(elems) * elem_type.format_size
+            return buff.pack_array(offset, size, elem_type.array_typecode, elems)
+
+        for elem in elems:
             offset, format_code = elem_type.emit_value_long(buff, offset, elem)
 
         return offset
 
-    def decode_from(self, buff, offset, count, elem_type, elem_format_code, elem_descriptor):
-        elems = [None] * count
-
-        for i in range(count):
-            offset, elems[i] = elem_type.parse_value(buff, offset, elem_format_code)
-
-        return offset, Array(elem_type, elems, elem_descriptor)
-
     def emit_elem_constructor(self, buff, offset, value):
         elem_type = _get_data_type_for_python_type(value.element_type)
         elem_descriptor = value.element_descriptor
 
         offset, elem_format_code_offset = elem_type.emit_constructor(buff, offset, elem_descriptor)
-        buff.pack(elem_format_code_offset, 1, "!B", elem_type.format_code)
+        buff.pack_ubyte(elem_format_code_offset, elem_type.format_code)
 
         return offset
 
@@ -579,29 +591,28 @@ class _ArrayType(_CollectionType):
 
         offset = self.emit_elem_constructor(buff, offset, value)
 
-        value_offset = offset
         offset = self.encode_into(buff, offset, value)
 
         size = offset - count_offset
 
         if size >= 256:
-            encoded_value = bytes(buff[value_offset:offset])
-            return self.emit_value_long(buff, size_offset, value, encoded_value)
+            # Widen the size and count fields in place.  The element
+            # constructor moves along with the elements.
+            offset = buff.move(count_offset + 1, offset, count_offset + 7)
+            buff.pack(size_offset, 8, "!II", size + 3, count)
+
+            return offset, self.long_format_code
 
         buff.pack(size_offset, 2, "!BB", size, count)
 
         return offset, self.short_format_code
 
-    def emit_value_long(self, buff, offset, value, encoded_value=None):
+    def emit_value_long(self, buff, offset, value):
         offset, size_offset = buff.skip(offset, 4)
         offset, count_offset = buff.skip(offset, 4)
 
         offset = self.emit_elem_constructor(buff, offset, value)
-
-        if encoded_value is None:
-            offset = self.encode_into(buff, offset, value)
-        else:
-            offset = buff.write(offset, encoded_value)
+        offset = self.encode_into(buff, offset, value)
 
         size = offset - count_offset
         count = len(value.elements)
@@ -610,17 +621,6 @@ class _ArrayType(_CollectionType):
 
         return offset, self.long_format_code
 
-    def parse_value(self, buff, offset, format_code):
-        offset, size, count = self.parse_size_and_count(buff, offset, format_code)
-        offset, elem_format_code, elem_descriptor = _parse_constructor(buff, offset)
-
-        elem_type = _get_data_type_for_format_code(elem_format_code)
-
-        offset, value = self.decode_from \
-            (buff, offset, count, elem_type, elem_format_code, elem_descriptor)
-
-        return offset, value
-
 _null_type = _NullType()
 _boolean_type = _BooleanType()
 _ubyte_type = UnsignedByte._data_type = _UnsignedByteType()
@@ -642,6 +642,43 @@ _uuid_type = Uuid._data_type = _UuidType()
 _binary_type = _BinaryType()
 _string_type = _StringType()
 _symbol_type = Symbol._data_type = _SymbolType()
+
+# The encoded-value caches used by emit_data, with hits and misses
+# counters.  Set max_size to 0 to turn one off.
+encoded_string_cache = _string_type.encoded_cache
+encoded_symbol_cache = _symbol_type.encoded_cache
+
+class _TypedListType(_ListType):
+    def __init__(self, element_type):
+        super().__init__()
+
+        self.emit_element = _get_hinted_emitter(element_type)
+
+    def encode_into(self, buff, offset, value):
+        emit_element = self.emit_element
+
+        for item in value:
+            offset = emit_element(buff, offset, item)
+
+        return offset
+
+class _TypedMapType(_MapType):
+    def __init__(self, key_type, value_type):
+        super().__init__()
+
+        self.emit_item_key = _get_hinted_emitter(key_type)
+        self.emit_item_value = _get_hinted_emitter(value_type)
+
+    def encode_into(self, buff, offset, value):
+        emit_item_key = self.emit_item_key
+        emit_item_value = self.emit_item_value
+
+        for item_key, item_value in value.items():
+            offset = emit_item_key(buff, offset, item_key)
+            offset = emit_item_value(buff, offset, item_value)
+
+        return offset
+
 _list_type = _ListType()
 _map_type = _MapType()
 _array_type = Array._data_type = _ArrayType()
@@ -694,7 +731,17 @@ def _get_data_type_for_format_code(format_code):
     except KeyError:
         raise Exception("No data type for format code 0x{:02X}".format(format_code))
 
+_data_types_by_python_type = dict()
+
 def _get_data_type_for_python_type(python_type):
+    try:
+        return _data_types_by_python_type[python_type]
+    except KeyError:
+        data_type = _find_data_type_for_python_type(python_type)
+        _data_types_by_python_type[python_type] = data_type
+        return data_type
+
+def _find_data_type_for_python_type(python_type):
     if hasattr(python_type, "_data_type"):
         return python_type._data_type
 
@@ -730,39 +777,1208 @@ def register_value_class(descriptor, value_class):
     assert descriptor not in _value_classes_by_descriptor
     _value_classes_by_descriptor[descriptor] = value_class
 
-def emit_data(buff, offset, value):
-    python_type = type(value)
-
+# Described lists with declared fields, such as the performatives, can
+# be compiled into straight-line emit and parse functions.  The
+# emitters are keyed by class and the parsers by the code of a
+# smallulong descriptor.
+
+_described_list_emitters = dict()
+_described_list_parsers = [None] * 256
+
+def _compile_described_list(value_class):
+    descriptor = value_class()._descriptor
+    types_by_index = dict()
+
+    for name in dir(value_class):
+        attr = getattr(value_class, name)
+
+        if isinstance(attr, property) and attr in _field_specs_by_property:
+            index, type_ = _field_specs_by_property[attr]
+            types_by_index[index] = type_
+
+    field_count = max(types_by_index) + 1
+    types = [types_by_index.get(i) for i in range(field_count)]
+    name = value_class.__name__
+
+    buff = Buffer(16)
+    prefix = bytes(buff[0:_emit_descriptor(buff, buff.pack_ubyte(0, 0x00), descriptor)])
+
+    namespace = {
+        "value_class": value_class,
+        "prefix": prefix,
+        "emit_data": emit_data,
+        "emit_described_data": _emit_described_data,
+    }
+
+    for i, type_ in enumerate(types):
+        if isinstance(type_, (TypedList, TypedMap)):
+            namespace["emit_field_{}".format(i)] = _get_hinted_emitter(type_)
+        elif type_ is not None:
+            data_type = _get_data_type_for_python_type(type_)
+
+            namespace["type_{}".format(i)] = type_
+            namespace["plain_type_{}".format(i)] = _get_plain_type(type_)
+            namespace["emit_value_{}".format(i)] = data_type.emit_value
+
+            if data_type.encoded_cache is not None:
+                namespace["emit_cached_{}".format(i)] = data_type.emit_cached
+
+    exec(_described_list_emitter_source(name, types), namespace)
+
+    value_class._field_count = field_count
+
+    _described_list_emitters[value_class] = namespace["_emit_" + name]
+    _emitters_by_python_type.pop(value_class, None)
+
+    if prefix[1] == 0x53:
+        exec(_described_list_parser_source(name, types), namespace)
+        _described_list_parsers[prefix[2]] = namespace["_parse_" + name]
+
+def _described_list_emitter_source(name, types):
+    lines = [
+        "def _emit_{}(buff, offset, value):".format(name),
+        "    fields = value._value",
+        "    if type(fields) is not list or len(fields) > {}:".format(len(types)),
+        "        return emit_described_data(buff, offset, value)",
+        "    count = len(fields)",
+        "    while count and fields[count - 1] is None:",
+        "        count -= 1",
+        "    offset = buff.write(offset, prefix)",
+        "    if count == 0:",
+        "        return buff.pack_ubyte(offset, 0x45)",
+        "    format_code_offset = offset",
+        "    offset += 3",
+        "    value_offset = offset",
+    ]
+
+    # Nest each field under the check for the one before, so emitting
+    # stops at the last field that is set
+    indent = "    "
+
+    for i, type_ in enumerate(types):
+        if i > 0:
+            lines.append(indent + "if count > {}:".format(i))
+            indent += "    "
+
+        if type_ is None:
+            lines.append(indent + "offset = emit_data(buff, offset, fields[{}])".format(i))
+            continue
+
+        if isinstance(type_, (TypedList, TypedMap)):
+            lines.append(indent + "offset = emit_field_{}(buff, offset, fields[{}])".format(i, i))
+            continue
+
+        lines += [
+            indent + "field = fields[{}]".format(i),
+            indent + "if field is None:",
+            indent + "    offset = buff.pack_ubyte(offset, 0x40)",
+        ]
+
+        # Booleans and unsigned ints are encoded inline.  MicroPython
+        # needs the int conversion in the data type.
+        if type_ is bool:
+            lines += [
+                indent + "elif field is True:",
+                indent + "    offset = buff.pack_ubyte(offset, 0x41)",
+                indent + "elif field is False:",
+                indent + "    offset = buff.pack_ubyte(offset, 0x42)",
+            ]
+        elif type_ is UnsignedInt and not _micropython:
+            lines += [
+                indent + "elif type(field) is type_{} or type(field) is plain_type_{}:".format(i, i),
+                indent + "    if field == 0:",
+                indent + "        offset = buff.pack_ubyte(offset, 0x43)",
+                indent + "    elif field < 256:",
+                indent + "        offset = buff.pack(offset, 2, '!BB', 0x52, field)",
+                indent + "    else:",
+                indent + "        offset = buff.pack(offset, 5, '!BI', 0x70, field)",
+            ]
+        elif _get_data_type_for_python_type(type_).encoded_cache is not None:
+            lines += [
+                indent + "elif type(field) is type_{} or type(field) is plain_type_{}:".format(i, i),
+                indent + "    offset = emit_cached_{}(buff, offset, field)".format(i),
+            ]
+        else:
+            lines += [
+                indent + "elif type(field) is type_{} or type(field) is plain_type_{}:".format(i, i),
+                indent + "    start = offset",
+                indent + "    offset, format_code = emit_value_{}(buff, offset + 1, field)".format(i),
+                indent + "    buff.pack_ubyte(start, format_code)",
+            ]
+
+        lines += [
+            indent + "else:",
+            indent + "    offset = emit_data(buff, offset, field)",
+        ]
+
+    lines += [
+        "    size = offset - format_code_offset - 2",
+        "    if size >= 256:",
+        "        offset = buff.move(value_offset, offset, value_offset + 6)",
+        "        buff.pack(format_code_offset, 9, '!BII', 0xd0, size + 3, count)",
+        "        return offset",
+        "    buff.pack(format_code_offset, 3, '!BBB', 0xc0, size, count)",
+        "    return offset",
+    ]
+
+    return "\n".join(lines)
+
+def _described_list_parser_source(name, types):
+    lines = [
+        "def _parse_{}(decoder, buff, offset):".format(name),
+        "    format_code = buff.unpack_ubyte(offset)",
+        "    if format_code == 0xc0:",
+        "        count = buff.unpack_ubyte(offset + 2)",
+        "        items_offset = offset + 3",
+        "        end = offset + 2 + buff.unpack_ubyte(offset + 1)",
+        "    elif format_code == 0xd0:",
+        "        count = buff.unpack_uint(offset + 5)",
+        "        items_offset = offset + 9",
+        "        end = offset + 5 + buff.unpack_uint(offset + 1)",
+        "    else:",
+        "        count = -1",
+        "    if count < 0 or count > {}:".format(len(types)),
+        "        offset, value = decoder.parse_value(buff, offset + 1, format_code)",
+        "        return offset, value_class(value)",
+        "    outer_end = decoder._enter(buff, end)",
+        "    try:",
+        "        offset = items_offset",
+        "        values = [None] * count",
+    ]
+
+    indent = "        "
+
+    # The common encodings of unsigned ints and booleans are decoded
+    # inline.  Everything else goes through the decoder.
+    for i, type_ in enumerate(types):
+        lines += [
+            indent + "if count > {}:".format(i),
+            indent + "    format_code = buff.unpack_ubyte(offset)",
+            indent + "    if format_code == 0x40:",
+            indent + "        offset += 1",
+        ]
+
+        if type_ is UnsignedInt:
+            lines += [
+                indent + "    elif format_code == 0x52:",
+                indent + "        values[{}] = buff.unpack_ubyte(offset + 1)".format(i),
+                indent + "        offset += 2",
+                indent + "    elif format_code == 0x43:",
+                indent + "        values[{}] = 0".format(i),
+                indent + "        offset += 1",
+            ]
+        elif type_ is bool:
+            lines += [
+                indent + "    elif format_code == 0x41:",
+                indent + "        values[{}] = True".format(i),
+                indent + "        offset += 1",
+                indent + "    elif format_code == 0x42:",
+                indent + "        values[{}] = False".format(i),
+                indent + "        offset += 1",
+            ]
+
+        lines += [
+            indent + "    else:",
+            indent + "        offset, values[{}] = decoder.parse(buff, offset)".format(i),
+        ]
+
+        indent += "    "
+
+    lines += [
+        "    finally:",
+        "        decoder._exit(outer_end)",
+        "    return offset, value_class(values)",
+    ]
+
+    return "\n".join(lines)
+
+# Resolved encoders keyed by exact Python type.  Subclasses get their
+# own entry on first use.
+_emitters_by_python_type = dict()
+
+def _get_emitter(python_type):
     if issubclass(python_type, DescribedValue):
-        python_type = type(value._value)
+        if python_type._cache_encoding:
+            emitter = _emit_cached_described_data
+        else:
+            emitter = _described_list_emitters.get(python_type, _emit_described_data)
+    else:
+        data_type = _get_data_type_for_python_type(python_type)
 
-    data_type = _get_data_type_for_python_type(python_type)
+        if data_type.encoded_cache is None:
+            emitter = data_type.emit
+        else:
+            emitter = data_type.emit_cached
 
+    _emitters_by_python_type[python_type] = emitter
+
+    return emitter
+
+def _emit_described_data(buff, offset, value):
+    python_type = type(value._value)
+    hint = value._value_type
+
+    if hint is not None:
+        data_type = _get_hinted_data_type(hint)
+
+        if data_type.python_type is python_type:
+            return data_type.emit(buff, offset, value)
+
+    data_type = _get_data_type_for_python_type(python_type)
     return data_type.emit(buff, offset, value)
 
-def parse_data(buff, offset):
-    offset, format_code, descriptor = _parse_constructor(buff, offset)
-    data_type = _get_data_type_for_format_code(format_code)
-    offset, value = data_type.parse_value(buff, offset, format_code)
+_data_types_by_hint = dict()
+
+def _get_hinted_data_type(hint):
+    try:
+        return _data_types_by_hint[hint]
+    except KeyError:
+        pass
+
+    if isinstance(hint, TypedList):
+        data_type = _TypedListType(hint.element_type)
+    elif isinstance(hint, TypedMap):
+        data_type = _TypedMapType(hint.key_type, hint.value_type)
+    else:
+        data_type = _get_data_type_for_python_type(hint)
+
+    _data_types_by_hint[hint] = data_type
+
+    return data_type
+
+def _get_plain_type(python_type):
+    for plain_type in (bool, int, float, str, bytes, list, dict):
+        if issubclass(python_type, plain_type):
+            return plain_type
+
+def _get_hinted_emitter(hint):
+    if hint is None:
+        return emit_data
+
+    data_type = _get_hinted_data_type(hint)
+    python_type = data_type.python_type
+    plain_type = _get_plain_type(python_type)
+    emit_value = data_type.emit_value
+
+    if data_type.encoded_cache is not None:
+        emit_cached = data_type.emit_cached
+
+        def emit(buff, offset, value):
+            value_type = type(value)
+
+            if value_type is python_type or value_type is plain_type:
+                return emit_cached(buff, offset, value)
+
+            return emit_data(buff, offset, value)
+
+        return emit
+
+    def emit(buff, offset, value):
+        value_type = type(value)
+
+        if value_type is python_type or value_type is plain_type:
+            start = offset
+            offset, format_code = emit_value(buff, offset + 1, value)
+            buff.pack_ubyte(start, format_code)
+
+            return offset
+
+        return emit_data(buff, offset, value)
+
+    return emit
+
+def _emit_cached_described_data(buff, offset, value):
+    octets = value._encoded
+
+    if octets is None:
+        start = offset
+        emitter = _described_list_emitters.get(type(value), _emit_described_data)
+        offset = emitter(buff, offset, value)
+        value._encoded = bytes(buff[start:offset])
+
+        return offset
+
+    return buff.write(offset, octets)
+
+# Descriptors are drawn from a small fixed set, so their encodings are
+# kept.  They are looked up by type as well as value so that, for
+# instance, an int descriptor does not pick up an UnsignedLong encoding.
+
+_descriptor_octets_by_type = dict()
+_descriptor_octets_max = 256
+
+def _emit_descriptor(buff, offset, descriptor):
+    try:
+        octets_by_descriptor = _descriptor_octets_by_type[type(descriptor)]
+    except KeyError:
+        octets_by_descriptor = _descriptor_octets_by_type[type(descriptor)] = dict()
+
+    try:
+        octets = octets_by_descriptor[descriptor]
+    except KeyError:
+        start = offset
+        offset = emit_data(buff, offset, descriptor)
+
+        if len(octets_by_descriptor) < _descriptor_octets_max:
+            octets_by_descriptor[descriptor] = bytes(buff[start:offset])
+
+        return offset
+
+    return buff.write(offset, octets)
+
+def emit_data(buff, offset, value):
+    try:
+        emitter = _emitters_by_python_type[type(value)]
+    except KeyError:
+        emitter = _get_emitter(type(value))
+
+    return emitter(buff, offset, value)
+
+class Decoder:
+    """
+    Parses encoded data using a table of parse functions indexed by
+    format code.  Each parse function takes the offset just past the
+    format code and returns the new offset and the decoded value.
+
+    With lazy=True, lists and maps are returned as LazyList and
+    LazyMap views over the buffer.  Their items are decoded on first
+    access, so the views are only valid while the buffer contents are
+    unchanged.
+
+    With copy=False, binary values are returned as memoryview slices
+    of the buffer instead of bytes.  The same rule applies: the
+    transport reuses its input buffer once a frame is handled, so the
+    slices must not be kept past the frame callback.  Use bytes() to
+    keep a value.
+
+    The arrays option controls the elements of numeric arrays.  With
+    "list", the default, they are a list of Python values.  With
+    "array" or "numpy", they are an array.array or a NumPy array in
+    native byte order.
+
+    Short symbols, and short strings if string_cache_size is set, are
+    interned in LRU caches so that repeated values come back as the
+    same object.  The caches are available as symbol_cache and
+    string_cache, with hits and misses counters.
+
+    With raw=True, values are returned as plain int, float, str, and
+    bytes instead of the AMQP wrapper types.  Use
+    parse_with_format_code() where the AMQP type is still needed.
+
+    Corrupt or hostile input is checked before anything is allocated
+    for it.  A compound value may not declare more than max_count
+    items, more items than its size can hold, a size larger than
+    max_size, or a size that runs past the end of its container.
+    Compound values may nest max_depth deep.  A value that breaks a
+    limit raises an exception.
+
+    A decoder tracks the nesting and container ends of the value it is
+    parsing, so a decoder must not be used by two threads at once.
+    Each transport has its own, and parse_data() without a decoder
+    uses one per thread.
+    """
+
+    def __init__(self, lazy=False, copy=True, arrays="list", symbol_cache_size=256, string_cache_size=0,
+                 raw=False, max_count=1024 * 1024, max_depth=64, max_size=None):
+        assert arrays in ("list", "array", "numpy")
+
+        if arrays == "numpy" and _numpy is None:
+            raise Exception("NumPy is not available")
+
+        self.max_count = max_count
+        self.max_depth = max_depth
+        self.max_size = max_size
+
+        # Encoded sizes are at most 32 bits
+        self._max_size = (1 << 32) if max_size is None else max_size
+        self._depth = 0
+
+        # The end of the value or frame being parsed.  No value inside
+        # it may run past it.  None means the end of the buffer.
+        self._end = None
+
+        self._arrays = arrays
+        self._raw = raw
+        self._symbol_type = str if raw else Symbol
+
+        parsers = [None] * 256
+
+        parsers[0x40] = self._parse_null
+        parsers[0x41] = self._parse_true
+        parsers[0x42] = self._parse_false
+        parsers[0x43] = self._parse_uint0
+        parsers[0x44] = self._parse_ulong0
+        parsers[0x45] = self._parse_list0
+        parsers[0x50] = self._parse_ubyte
+        parsers[0x51] = self._parse_byte
+        parsers[0x52] = self._parse_smalluint
+        parsers[0x53] = self._parse_smallulong
+        parsers[0x54] = self._parse_smallint
+        parsers[0x55] = self._parse_smalllong
+        parsers[0x56] = self._parse_boolean
+        parsers[0x60] = self._parse_ushort
+        parsers[0x61] = self._parse_short
+        parsers[0x70] = self._parse_uint
+        parsers[0x71] = self._parse_int
+        parsers[0x72] = self._parse_float
+        parsers[0x73] = self._parse_char
+        parsers[0x74] = self._parse_decimal32
+        parsers[0x80] = self._parse_ulong
+        parsers[0x81] = self._parse_long
+        parsers[0x82] = self._parse_double
+        parsers[0x83] = self._parse_timestamp
+        parsers[0x84] = self._parse_decimal64
+        parsers[0x94] = self._parse_decimal128
+        parsers[0x98] = self._parse_uuid
+        parsers[0xa0] = self._parse_vbin8
+        parsers[0xa1] = self._parse_str8
+        parsers[0xa3] = self._parse_sym8
+        parsers[0xb0] = self._parse_vbin32
+        parsers[0xb1] = self._parse_str32
+        parsers[0xb3] = self._parse_sym32
+        parsers[0xc0] = self._parse_list8
+        parsers[0xc1] = self._parse_map8
+        parsers[0xd0] = self._parse_list32
+        parsers[0xd1] = self._parse_map32
+        parsers[_array_type.short_format_code] = self._parse_array_short
+        parsers[_array_type.long_format_code] = self._parse_array_long
+
+        if not copy:
+            parsers[0xa0] = self._parse_vbin8_view
+            parsers[0xb0] = self._parse_vbin32_view
+
+        if raw:
+            parsers[0x50] = self._parse_ubyte_raw
+            parsers[0x51] = self._parse_byte_raw
+            parsers[0x60] = self._parse_ushort_raw
+            parsers[0x61] = self._parse_short_raw
+            parsers[0x70] = self._parse_uint_raw
+            parsers[0x71] = self._parse_int_raw
+            parsers[0x72] = self._parse_float_raw
+            parsers[0x73] = self._parse_char_raw
+            parsers[0x74] = self._parse_decimal32_raw
+            parsers[0x80] = self._parse_ulong_raw
+            parsers[0x83] = self._parse_timestamp_raw
+            parsers[0x84] = self._parse_decimal64_raw
+            parsers[0x94] = self._parse_decimal128_raw
+            parsers[0x98] = self._parse_uuid_raw
+            parsers[0xa3] = self._parse_str8
+            parsers[0xb3] = self._parse_str32
+
+        self.symbol_cache = None
+        self.string_cache = None
+
+        if symbol_cache_size:
+            self.symbol_cache = _LruCache(symbol_cache_size)
+            parsers[0xa3] = self._parse_sym8_interned
+
+        if string_cache_size:
+            self.string_cache = _LruCache(string_cache_size)
+            parsers[0xa1] = self._parse_str8_interned
+
+        if lazy:
+            parsers[0xc0] = self._parse_lazy_list8
+            parsers[0xc1] = self._parse_lazy_map8
+            parsers[0xd0] = self._parse_lazy_list32
+            parsers[0xd1] = self._parse_lazy_map32
+
+        self._parsers = parsers
+
+        # In lazy mode the field lists of described values are left
+        # lazy too, so the compiled parsers are not used
+        self._described_list_parsers = None if lazy else _described_list_parsers
+
+    def parse(self, buff, offset):
+        format_code = buff.unpack_ubyte(offset)
+
+        if format_code != 0x00:
+            return self.parse_value(buff, offset + 1, format_code)
+
+        described_list_parsers = self._described_list_parsers
+
+        if described_list_parsers is not None and buff.unpack_ubyte(offset + 1) == 0x53:
+            parser = described_list_parsers[buff.unpack_ubyte(offset + 2)]
+
+            if parser is not None:
+                return parser(self, buff, offset + 3)
+
+        offset, descriptor = self.parse(buff, offset + 1)
+        format_code = buff.unpack_ubyte(offset)
+        offset, value = self.parse_value(buff, offset + 1, format_code)
 
-    if descriptor is not None:
         try:
             value_class = _value_classes_by_descriptor[descriptor]
-            value = value_class(value)
         except KeyError:
-            value = DescribedValue(descriptor, value)
+            return offset, DescribedValue(descriptor, value)
+
+        return offset, value_class(value)
+
+    def parse_within(self, buff, offset, end):
+        """
+        Parses like parse() but rejects any value that runs past end,
+        such as the end of the enclosing frame.
+        """
+
+        outer_end = self._end
+        self._end = end
+
+        try:
+            return self.parse(buff, offset)
+        finally:
+            self._end = outer_end
+
+    def parse_with_format_code(self, buff, offset):
+        """
+        Parses like parse() and also returns the format code of the
+        value, after any descriptor.
+        """
 
-    return offset, value
+        format_code = buff.unpack_ubyte(offset)
 
-def _parse_constructor(buff, offset):
-    offset, format_code = buff.unpack(offset, 1, "!B")
-    descriptor = None
+        if format_code == 0x00:
+            format_code = buff.unpack_ubyte(skip_data(buff, offset + 1))
+
+        offset, value = self.parse(buff, offset)
+
+        return offset, value, format_code
+
+    def parse_value(self, buff, offset, format_code):
+        parser = self._parsers[format_code]
+
+        if parser is None:
+            raise Exception("No data type for format code 0x{:02X}".format(format_code))
+
+        return parser(buff, offset)
+
+    def _parse_null(self, buff, offset):
+        return offset, None
+
+    def _parse_true(self, buff, offset):
+        return offset, True
+
+    def _parse_false(self, buff, offset):
+        return offset, False
+
+    def _parse_boolean(self, buff, offset):
+        return offset + 1, buff.unpack_ubyte(offset) == 0x01
+
+    def _parse_uint0(self, buff, offset):
+        return offset, 0
+
+    def _parse_ulong0(self, buff, offset):
+        return offset, 0
+
+    def _parse_smalluint(self, buff, offset):
+        return offset + 1, buff.unpack_ubyte(offset)
+
+    def _parse_smallulong(self, buff, offset):
+        return offset + 1, buff.unpack_ubyte(offset)
+
+    def _parse_smallint(self, buff, offset):
+        return offset + 1, buff.unpack_byte(offset)
+
+    def _parse_smalllong(self, buff, offset):
+        return offset + 1, buff.unpack_byte(offset)
+
+    def _parse_ubyte(self, buff, offset):
+        return offset + 1, UnsignedByte(buff.unpack_ubyte(offset))
+
+    def _parse_ushort(self, buff, offset):
+        return offset + 2, UnsignedShort(buff.unpack_ushort(offset))
+
+    def _parse_uint(self, buff, offset):
+        return offset + 4, UnsignedInt(buff.unpack_uint(offset))
+
+    def _parse_ulong(self, buff, offset):
+        return offset + 8, UnsignedLong(buff.unpack_ulong(offset))
+
+    def _parse_byte(self, buff, offset):
+        return offset + 1, Byte(buff.unpack_byte(offset))
+
+    def _parse_short(self, buff, offset):
+        return offset + 2, Short(buff.unpack_short(offset))
+
+    def _parse_int(self, buff, offset):
+        return offset + 4, Int(buff.unpack_int(offset))
+
+    def _parse_long(self, buff, offset):
+        return offset + 8, buff.unpack_long(offset)
+
+    def _parse_float(self, buff, offset):
+        return offset + 4, Float(buff.unpack_float(offset))
+
+    def _parse_double(self, buff, offset):
+        return offset + 8, buff.unpack_double(offset)
+
+    def _parse_decimal32(self, buff, offset):
+        offset, octets = buff.read(offset, 4)
+        return offset, Decimal32(octets)
+
+    def _parse_decimal64(self, buff, offset):
+        offset, octets = buff.read(offset, 8)
+        return offset, Decimal64(octets)
+
+    def _parse_decimal128(self, buff, offset):
+        offset, octets = buff.read(offset, 16)
+        return offset, Decimal128(octets)
+
+    def _parse_char(self, buff, offset):
+        offset, octets = buff.read(offset, 4)
+        return offset, Char(str(octets, "utf-32-be"))
+
+    def _parse_timestamp(self, buff, offset):
+        return offset + 8, Timestamp(round(buff.unpack_long(offset) / 1000, 3))
+
+    def _parse_uuid(self, buff, offset):
+        offset, octets = buff.read(offset, 16)
+        return offset, Uuid(octets)
+
+    def _parse_vbin8(self, buff, offset):
+        size = buff.unpack_ubyte(offset)
+        self._check_end(buff, offset + 1 + size)
+        offset, octets = buff.read(offset + 1, size)
+        return offset, bytes(octets)
+
+    def _parse_vbin32(self, buff, offset):
+        size = self._check_size(buff, offset + 4, buff.unpack_uint(offset))
+        offset, octets = buff.read(offset + 4, size)
+        return offset, bytes(octets)
+
+    def _parse_vbin8_view(self, buff, offset):
+        size = buff.unpack_ubyte(offset)
+        self._check_end(buff, offset + 1 + size)
+        return buff.read(offset + 1, size)
+
+    def _parse_vbin32_view(self, buff, offset):
+        return buff.read(offset + 4, self._check_size(buff, offset + 4, buff.unpack_uint(offset)))
+
+    # str() decodes straight from the buffer without an intermediate
+    # bytes copy
+
+    def _parse_str8(self, buff, offset):
+        size = buff.unpack_ubyte(offset)
+        self._check_end(buff, offset + 1 + size)
+        offset, octets = buff.read(offset + 1, size)
+        return offset, str(octets, "utf-8")
+
+    def _parse_str32(self, buff, offset):
+        size = self._check_size(buff, offset + 4, buff.unpack_uint(offset))
+        offset, octets = buff.read(offset + 4, size)
+        return offset, str(octets, "utf-8")
+
+    def _parse_sym8(self, buff, offset):
+        size = buff.unpack_ubyte(offset)
+        self._check_end(buff, offset + 1 + size)
+        offset, octets = buff.read(offset + 1, size)
+        return offset, Symbol(str(octets, "ascii"))
+
+    def _parse_sym32(self, buff, offset):
+        size = self._check_size(buff, offset + 4, buff.unpack_uint(offset))
+        offset, octets = buff.read(offset + 4, size)
+        return offset, Symbol(str(octets, "ascii"))
+
+    # Raw mode returns the plain Python values behind the wrapper types.
+    # Symbols are parsed as strings.
+
+    def _parse_ubyte_raw(self, buff, offset):
+        return offset + 1, buff.unpack_ubyte(offset)
+
+    def _parse_ushort_raw(self, buff, offset):
+        return offset + 2, buff.unpack_ushort(offset)
+
+    def _parse_uint_raw(self, buff, offset):
+        return offset + 4, buff.unpack_uint(offset)
+
+    def _parse_ulong_raw(self, buff, offset):
+        return offset + 8, buff.unpack_ulong(offset)
+
+    def _parse_byte_raw(self, buff, offset):
+        return offset + 1, buff.unpack_byte(offset)
+
+    def _parse_short_raw(self, buff, offset):
+        return offset + 2, buff.unpack_short(offset)
+
+    def _parse_int_raw(self, buff, offset):
+        return offset + 4, buff.unpack_int(offset)
+
+    def _parse_float_raw(self, buff, offset):
+        return offset + 4, buff.unpack_float(offset)
+
+    def _parse_char_raw(self, buff, offset):
+        offset, octets = buff.read(offset, 4)
+        return offset, str(octets, "utf-32-be")
+
+    def _parse_timestamp_raw(self, buff, offset):
+        return offset + 8, round(buff.unpack_long(offset) / 1000, 3)
+
+    def _parse_decimal32_raw(self, buff, offset):
+        offset, octets = buff.read(offset, 4)
+        return offset, bytes(octets)
+
+    def _parse_decimal64_raw(self, buff, offset):
+        offset, octets = buff.read(offset, 8)
+        return offset, bytes(octets)
+
+    def _parse_decimal128_raw(self, buff, offset):
+        offset, octets = buff.read(offset, 16)
+        return offset, bytes(octets)
+
+    def _parse_uuid_raw(self, buff, offset):
+        offset, octets = buff.read(offset, 16)
+        return offset, bytes(octets)
+
+    # Only the one-octet-size encodings are interned.  Longer values
+    # are rarely repeated and would crowd out the rest.
+
+    def _parse_str8_interned(self, buff, offset):
+        size = buff.unpack_ubyte(offset)
+        self._check_end(buff, offset + 1 + size)
+        offset, octets = buff.read(offset + 1, size)
+        string = str(octets, "utf-8")
+        value = self.string_cache.get(string)
+
+        if value is None:
+            value = string
+            self.string_cache.put(string, value)
+
+        return offset, value
+
+    def _parse_sym8_interned(self, buff, offset):
+        size = buff.unpack_ubyte(offset)
+        self._check_end(buff, offset + 1 + size)
+        offset, octets = buff.read(offset + 1, size)
+        string = str(octets, "ascii")
+        value = self.symbol_cache.get(string)
+
+        if value is None:
+            value = self._symbol_type(string)
+            self.symbol_cache.put(string, value)
+
+        return offset, value
+
+    # The short compound encodings have a one-octet size and count.
+    # The long ones have four-octet fields.  Sizes include the count
+    # field.
+
+    # Every variable-width or compound value must end within the one
+    # that holds it, and the items of a compound value are parsed with
+    # its end as the limit.  The count and size limits are checked for
+    # the long forms only.  A short form cannot declare more than 255
+    # items or octets.
+
+    def _check_end(self, buff, end):
+        limit = self._end
+
+        if limit is None:
+            limit = len(buff)
+
+        if end > limit:
+            raise Exception("Value ends at {}, past the end of its container at {}".format(end, limit))
+
+    def _check_size(self, buff, offset, size):
+        # Returns the size of the value at offset once it is known to
+        # fit in its container
+        if size > self._max_size:
+            raise Exception("Size {} exceeds the limit of {}".format(size, self._max_size))
+
+        self._check_end(buff, offset + size)
+
+        return size
+
+    def _check_count(self, size, count, min_size):
+        # Returns the count of items in a compound value.  min_size is
+        # the fewest octets the items can take.
+        if count > self.max_count:
+            raise Exception("Count {} exceeds the limit of {}".format(count, self.max_count))
+
+        if size > self._max_size:
+            raise Exception("Size {} exceeds the limit of {}".format(size, self._max_size))
+
+        if min_size > size:
+            raise Exception("Count {} does not fit in size {}".format(count, size))
+
+        return count
+
+    def _enter(self, buff, end):
+        # Called before the items of a compound value ending at end
+        # are parsed.  Returns the outer end to pass to _exit().
+        self._check_end(buff, end)
+
+        if self._depth >= self.max_depth:
+            raise Exception("Nesting exceeds the limit of {}".format(self.max_depth))
+
+        self._depth += 1
+
+        outer_end = self._end
+        self._end = end
+
+        return outer_end
+
+    def _exit(self, outer_end):
+        self._depth -= 1
+        self._end = outer_end
+
+    def _parse_list0(self, buff, offset):
+        return offset, list()
+
+    def _parse_list8(self, buff, offset):
+        end = offset + 1 + buff.unpack_ubyte(offset)
+        return self._parse_list_items(buff, offset + 2, buff.unpack_ubyte(offset + 1), end)
+
+    def _parse_list32(self, buff, offset):
+        size = buff.unpack_uint(offset)
+        count = self._check_count(size, buff.unpack_uint(offset + 4), 4)
+
+        return self._parse_list_items(buff, offset + 8, count, offset + 4 + size)
+
+    def _parse_list_items(self, buff, offset, count, end):
+        outer_end = self._enter(buff, end)
+
+        try:
+            if offset + count > end:
+                raise Exception("Count {} does not fit in size {}".format(count, end - offset))
+
+            value = [None] * count
+
+            for i in range(count):
+                offset, value[i] = self.parse(buff, offset)
+        finally:
+            self._exit(outer_end)
+
+        return offset, value
+
+    def _parse_map8(self, buff, offset):
+        end = offset + 1 + buff.unpack_ubyte(offset)
+        return self._parse_map_items(buff, offset + 2, buff.unpack_ubyte(offset + 1), end)
+
+    def _parse_map32(self, buff, offset):
+        size = buff.unpack_uint(offset)
+        count = self._check_count(size, buff.unpack_uint(offset + 4), 4)
+
+        return self._parse_map_items(buff, offset + 8, count, offset + 4 + size)
+
+    def _parse_map_items(self, buff, offset, count, end):
+        items = dict()
+
+        outer_end = self._enter(buff, end)
+
+        try:
+            if offset + count > end:
+                raise Exception("Count {} does not fit in size {}".format(count, end - offset))
+
+            for i in range(0, count, 2):
+                offset, item_key = self.parse(buff, offset)
+                offset, item_value = self.parse(buff, offset)
+
+                items[item_key] = item_value
+        finally:
+            self._exit(outer_end)
+
+        return offset, items
+
+    def _parse_lazy_list8(self, buff, offset):
+        end = offset + 1 + buff.unpack_ubyte(offset)
+        self._check_end(buff, end)
+
+        return end, LazyList(self, buff, offset + 2, buff.unpack_ubyte(offset + 1), end)
+
+    def _parse_lazy_list32(self, buff, offset):
+        size = buff.unpack_uint(offset)
+        count = buff.unpack_uint(offset + 4)
+        count = self._check_count(size, count, 4 + count)
+        end = offset + 4 + size
+        self._check_end(buff, end)
+
+        return end, LazyList(self, buff, offset + 8, count, end)
+
+    def _parse_lazy_map8(self, buff, offset):
+        end = offset + 1 + buff.unpack_ubyte(offset)
+        self._check_end(buff, end)
+
+        return end, LazyMap(self, buff, offset + 2, buff.unpack_ubyte(offset + 1), end)
+
+    def _parse_lazy_map32(self, buff, offset):
+        size = buff.unpack_uint(offset)
+        count = buff.unpack_uint(offset + 4)
+        count = self._check_count(size, count, 4 + count)
+        end = offset + 4 + size
+        self._check_end(buff, end)
+
+        return end, LazyMap(self, buff, offset + 8, count, end)
+
+    def _parse_array_short(self, buff, offset):
+        end = offset + 1 + buff.unpack_ubyte(offset)
+        return self._parse_array_elements(buff, offset + 2, buff.unpack_ubyte(offset + 1), end)
+
+    def _parse_array_long(self, buff, offset):
+        size = buff.unpack_uint(offset)
+        count = self._check_count(size, buff.unpack_uint(offset + 4), 5)
+
+        return self._parse_array_elements(buff, offset + 8, count, offset + 4 + size)
+
+    def _parse_array_elements(self, buff, offset, count, end):
+        outer_end = self._enter(buff, end)
+
+        try:
+            elem_format_code = buff.unpack_ubyte(offset)
+            elem_descriptor = None
+
+            if elem_format_code == 0x00:
+                offset, elem_descriptor = self.parse(buff, offset + 1)
+                elem_format_code = buff.unpack_ubyte(offset)
+
+            offset += 1
+            elem_type = _get_data_type_for_format_code(elem_format_code)
+
+            # The element width is known from the constructor, so the
+            # count can be checked against the octets left
+            width = _skip_widths[elem_format_code]
+
+            if offset + count * (width if width >= 0 else -width) > end:
+                raise Exception("Count {} does not fit in size {}".format(count, end - offset))
+
+            if elem_type.array_typecode is not None and elem_format_code == elem_type.format_code:
+                offset, elems = self._parse_packed_elements(buff, offset, count, elem_type)
+            else:
+                elems = [None] * count
+
+                for i in range(count):
+                    offset, elems[i] = self.parse_value(buff, offset, elem_format_code)
+        finally:
+            self._exit(outer_end)
+
+        return offset, Array(elem_type, elems, elem_descriptor)
+
+    def _parse_packed_elements(self, buff, offset, count, elem_type):
+        typecode = elem_type.array_typecode
+        size = count * elem_type.format_size
+
+        if self._arrays == "numpy":
+            offset, octets = buff.read(offset, size)
+            dtype = _numpy_dtypes[typecode]
+            elems = _numpy.frombuffer(octets, ">" + dtype, count).astype("=" + dtype)
+
+            return offset, elems
+
+        if self._arrays == "array" and not _micropython:
+            offset, octets = buff.read(offset, size)
+
+            elems = _array.array(typecode)
+            elems.frombytes(octets)
+
+            if _sys.byteorder == "little":
+                elems.byteswap()
+
+            return offset, elems
+
+        offset, elems = buff.unpack_array(offset, size, count, typecode)
+
+        if self._arrays == "array":
+            return offset, _array.array(typecode, elems)
+
+        python_type = elem_type.python_type
+
+        if self._raw or python_type is int or python_type is float:
+            return offset, list(elems)
+
+        return offset, [python_type(x) for x in elems]
+
+_undecoded = object()
+
+class LazyList:
+    __slots__ = "_decoder", "_buff", "_end", "_offsets", "_items"
+
+    def __init__(self, decoder, buff, offset, count, end):
+        self._decoder = decoder
+        self._buff = buff
+        self._end = end
+        self._offsets = [offset]
+        self._items = [_undecoded] * count
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._items)))]
+
+        item = self._items[index]
+
+        if item is _undecoded:
+            if index < 0:
+                index += len(self._items)
+
+            offset = self._get_offset(index)
+            item = self._items[index] = self._decoder.parse_within(self._buff, offset, self._end)[1]
+
+        return item
+
+    def __iter__(self):
+        for i in range(len(self._items)):
+            yield self[i]
+
+    def __eq__(self, other):
+        return list(self) == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def _get_offset(self, index):
+        offsets = self._offsets
+
+        while len(offsets) <= index:
+            offsets.append(skip_data(self._buff, offsets[-1]))
+
+        return offsets[index]
+
+class LazyMap:
+    __slots__ = "_decoder", "_buff", "_end", "_count", "_value_offsets", "_items", "_scan_offset"
+
+    def __init__(self, decoder, buff, offset, count, end):
+        self._decoder = decoder
+        self._buff = buff
+        self._end = end
+        self._count = count
+        self._value_offsets = dict()
+        self._items = dict()
+        self._scan_offset = offset
+
+    def __len__(self):
+        return self._count // 2
+
+    def __getitem__(self, key):
+        try:
+            return self._items[key]
+        except KeyError:
+            pass
+
+        try:
+            offset = self._value_offsets[key]
+        except KeyError:
+            offset = self._scan(key)
+
+        value = self._items[key] = self._decoder.parse_within(self._buff, offset, self._end)[1]
+
+        return value
+
+    def __contains__(self, key):
+        return key in self._value_offsets or self._scan(key, None) is not None
+
+    def __iter__(self):
+        self._scan(_undecoded, None)
+        return iter(self._value_offsets)
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+
+        return default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def _scan(self, key, default=_undecoded):
+        # Decode keys until the given key is found, recording the
+        # offset of each value as we go
+        buff = self._buff
+        offsets = self._value_offsets
+
+        while len(offsets) < self._count // 2:
+            offset, item_key = self._decoder.parse_within(buff, self._scan_offset, self._end)
+
+            offsets[item_key] = offset
+            self._scan_offset = skip_data(buff, offset)
+
+            if item_key == key:
+                return offset
+
+        if default is _undecoded:
+            raise KeyError(key)
+
+        return default
+
+# The octets to skip after each format code, taken from the format
+# codes the decoder knows.  A negative entry is the width of the size
+# field that gives the remaining length.  0x4 through 0x9 are fixed
+# widths of 0, 1, 2, 4, 8, and 16.
+
+def _get_skip_widths(parsers):
+    widths = [None] * 256
+
+    for format_code, parser in enumerate(parsers):
+        if parser is None:
+            continue
+
+        category = format_code >> 4
+
+        if category < 0xa:
+            widths[format_code] = (0, 1, 2, 4, 8, 16)[category - 4]
+        elif category in (0xa, 0xc) or format_code == _array_type.short_format_code:
+            widths[format_code] = -1
+        else:
+            widths[format_code] = -4
+
+    return widths
+
+_skip_widths = _get_skip_widths(Decoder()._parsers)
+
+def skip_data(buff, offset):
+    """
+    Returns the offset just past the value at offset, described or
+    not, without decoding it.
+    """
+
+    format_code = buff.unpack_ubyte(offset)
 
     if format_code == 0x00:
-        offset, descriptor = parse_data(buff, offset)
-        offset, format_code = buff.unpack(offset, 1, "!B")
+        offset = skip_data(buff, offset + 1)
+        format_code = buff.unpack_ubyte(offset)
+
+    width = _skip_widths[format_code]
+
+    if width is None:
+        raise Exception("No data type for format code 0x{:02X}".format(format_code))
+
+    if width >= 0:
+        return offset + 1 + width
+
+    if width == -1:
+        return offset + 2 + buff.unpack_ubyte(offset + 1)
+
+    return offset + 5 + buff.unpack_uint(offset + 1)
+
+if _threading is None:
+    _decoder = Decoder()
+
+    def _get_decoder():
+        return _decoder
+else:
+    _decoders = _threading.local()
+
+    def _get_decoder():
+        try:
+            return _decoders.decoder
+        except AttributeError:
+            decoder = _decoders.decoder = Decoder()
+            return decoder
+
+def parse_data(buff, offset, decoder=None):
+    if decoder is None:
+        decoder = _get_decoder()
 
-    return offset, format_code, descriptor
+    return decoder.parse(buff, offset)
 
 def _data_hex(octets):
     o = _hex(octets)
@@ -18,7 +18,7 @@
 #
 
 from argon.common import *
-from argon.common import _micropython, _shorten, _time, _uuid_bytes
+from argon.common import _micropython, _shorten, _threading, _time, _uuid_bytes
 from argon.data import *
 from argon.data import _data_hex, _hex
 
@@ -112,9 +112,158 @@ _input_values += [
     Array(Array, [Array(bool, [True, False]), Array(bool, [True, False])]),
 ]
 
+def _parse_error(buff, decoder=Decoder()):
+    try:
+        decoder.parse(buff, 0)
+    except Exception as e:
+        return str(e)
+
+    assert False, "Expected a limit error"
+
+def _check_limits():
+    # Nested list32 headers that each claim more octets than the one
+    # holding them.  They must be rejected before any items are
+    # allocated.
+    levels = 20
+    count = 10 * 1000
+    buff = Buffer(levels * 9 + count)
+    offset = 0
+
+    for i in range(levels):
+        offset = buff.pack(offset, 9, "!BII", 0xd0, count + 4, count)
+
+    error = _parse_error(buff)
+    assert "past the end of its container" in error, error
+
+    # Short strings, symbols, and binaries that claim more octets than
+    # the frame holding them
+    for format_code in (0xa0, 0xa1, 0xa3):
+        buff = Buffer()
+        buff.pack(0, 5, "!BB3s", format_code, 200, b"abc")
+
+        for decoder in (Decoder(), Decoder(copy=False), Decoder(raw=True), Decoder(string_cache_size=16)):
+            try:
+                decoder.parse_within(buff, 0, 5)
+            except Exception as e:
+                assert "past the end of its container" in str(e), e
+            else:
+                assert False, "Expected a limit error"
+
+    # Well-formed lists nested deeper than max_depth
+    value = None
+
+    for i in range(10):
+        value = [value]
+
+    buff = Buffer()
+    emit_data(buff, 0, value)
+
+    assert parse_data(buff, 0, Decoder(max_depth=10))[1] == value
+
+    error = _parse_error(buff, Decoder(max_depth=9))
+    assert "Nesting exceeds" in error, error
+
+def _check_threads():
+    # Threads parsing nested values with the default decoder must not
+    # see each other's limits
+    if _threading is None:
+        return
+
+    value = [[[index, "x" * index]] for index in range(100)]
+    buff = Buffer()
+    end = emit_data(buff, 0, value)
+    errors = list()
+
+    def parse():
+        try:
+            for i in range(200):
+                assert parse_data(buff, 0) == (end, value)
+        except Exception as e:
+            errors.append(e)
+
+    # The encoded-value caches are shared by all threads, and so is the
+    # symbol cache of a decoder shared between them.  Unique values
+    # keep the caches evicting.
+    decoder = Decoder(symbol_cache_size=16)
+
+    def emit_and_parse(name):
+        buff = Buffer()
+
+        try:
+            for i in range(2000):
+                string = "id-{}-{}".format(name, i)
+                emit_data(buff, 0, string)
+                end = emit_data(buff, 0, Symbol(string))
+                assert decoder.parse(buff, 0) == (end, Symbol(string))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [_threading.Thread(target=parse) for i in range(4)]
+    threads += [_threading.Thread(target=emit_and_parse, args=(i,)) for i in range(4)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert not errors, errors
+
+def _check_raw():
+    # Raw values are plain Python values.  parse_with_format_code()
+    # still tells the AMQP types apart, and for a described value it
+    # gives the format code of the value after the descriptor.
+    cases = [
+        (UnsignedByte(1), int, 0x50),
+        (Byte(-1), int, 0x51),
+        (UnsignedShort(2), int, 0x60),
+        (Short(-2), int, 0x61),
+        (UnsignedInt(300), int, 0x70),
+        (Int(-300), int, 0x71),
+        (UnsignedLong(400), int, 0x80),
+        (Float(1.5), float, 0x72),
+        (Char("x"), str, 0x73),
+        (Timestamp(5), float, 0x83),
+        (Uuid(_uuid_bytes()), bytes, 0x98),
+        (Symbol("abc"), str, 0xa3),
+        (Symbol("x" * 300), str, 0xb3),
+        (DescribedValue(Symbol("d"), "abc"), DescribedValue, 0xa1),
+        (DescribedValue(Symbol("d"), [UnsignedInt(1)]), DescribedValue, 0xc0),
+    ]
+
+    decoder = Decoder(raw=True)
+
+    for value, type_, format_code in cases:
+        buff = Buffer()
+        end = emit_data(buff, 0, value)
+
+        offset, output_value = decoder.parse(buff, 0)
+        assert offset == end and output_value == value, (value, output_value)
+        assert type(output_value) is type_, (value, type(output_value))
+
+        offset, output_value, output_format_code = decoder.parse_with_format_code(buff, 0)
+        assert offset == end and output_value == value, (value, output_value)
+        assert output_format_code == format_code, (value, output_format_code)
+
+    # Items of compound and described values are raw too
+    value = [Symbol("a"), UnsignedInt(1), {Symbol("k"): UnsignedLong(2)}, DescribedValue(Symbol("d"), Symbol("b"))]
+    buff = Buffer()
+    emit_data(buff, 0, value)
+
+    output_value = decoder.parse(buff, 0)[1]
+    item = output_value[2].popitem()
+
+    assert output_value[:2] == value[:2] and type(output_value[0]) is str and type(output_value[1]) is int
+    assert item == ("k", 2) and type(item[0]) is str and type(item[1]) is int
+    assert type(output_value[3]._descriptor) is str and type(output_value[3]._value) is str
+
 def _main():
     debug = True
 
+    _check_limits()
+    _check_threads()
+    _check_raw()
+
     buff = Buffer()
     offset = 0
 
@@ -154,6 +303,23 @@ def _main():
 
         output_values.append(output_value)
 
+    offset = 0
+
+    for value in _input_values:
+        start = offset
+        offset = skip_data(buff, offset)
+
+        assert offset == parse_data(buff, start)[0], "Skipped to the wrong offset for {}".format(value)
+
+    offset = 0
+    lazy_decoder = Decoder(lazy=True)
+
+    for value in _input_values:
+        offset, output_value = parse_data(buff, offset, lazy_decoder)
+
+        msg = "Expected {} {} but got {} {}".format(type(value), value, type(output_value), output_value)
+        assert output_value == value, msg
+
     row = "{:4}  {:>24}  {:16}  {:>24}  {:16}  {}"
 
     for i, value in enumerate(_input_values):
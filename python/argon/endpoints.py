@@ -67,6 +67,14 @@ class Connection:
     def _on_transport_frame(self, frame):
         assert isinstance(frame, AmqpFrame)
 
+        # Transfers are the bulk of the traffic, so they are
+        # dispatched without decoding the full performative
+        if type(frame) is TransferFrame:
+            session = self.sessions_by_channel[frame.channel]
+            link = session.links_by_handle[frame.handle]
+            link._handle_transfer(frame)
+            return
+
         descriptor = frame.performative._descriptor
 
         if descriptor == OPEN_DESCRIPTOR:
@@ -106,9 +114,6 @@ class Connection:
             link._handle_flow(frame)
             return
 
-        if descriptor == TRANSFER_DESCRIPTOR:
-            return # XXX Only sending for now
-
         if descriptor == DISPOSITION_DESCRIPTOR:
             return # XXX All presettled for now
 
@@ -176,9 +181,9 @@ class Session(_Endpoint):
         super().__init__(connection, connection._channel_ids.next())
 
         self._begin = BeginPerformative()
-        self._begin.next_outgoing_id = UnsignedInt(0)
-        self._begin.incoming_window = UnsignedInt(0xffffffff)
-        self._begin.outgoing_window = UnsignedInt(0xffffffff)
+        self._begin.next_outgoing_id = 0
+        self._begin.incoming_window = 0xffffffff
+        self._begin.outgoing_window = 0xffffffff
 
         self._end = EndPerformative()
 
@@ -214,7 +219,7 @@ class _Link(_Endpoint):
 
         self.session = session
 
-        handle = UnsignedInt(self.session._link_handles.next())
+        handle = self.session._link_handles.next()
 
         if name is None:
             name = "{}-{}".format(self.connection.container_id, handle)
@@ -223,7 +228,7 @@ class _Link(_Endpoint):
         self._attach.name = name
         self._attach.handle = handle
         self._attach.role = role
-        self._attach.snd_settle_mode = UnsignedByte(1) # XXX Presettled
+        self._attach.snd_settle_mode = 1 # XXX Presettled
         self._attach.source = None
         self._attach.target = None
 
@@ -232,6 +237,7 @@ class _Link(_Endpoint):
         self._detach.closed = True
 
         self._delivery_ids = _Sequence()
+        self._transfer_template = TransferTemplate(self.channel, handle)
 
         self.session.links_by_name[self._attach.name] = self
         self.session.links_by_handle[self._attach.handle] = self
@@ -252,18 +258,18 @@ class _Link(_Endpoint):
     def on_flow(self):
         pass
 
-    def send(self, message):
-        self.connection._log_operation("link", "send")
+    def _handle_transfer(self, frame):
+        self.connection._log_event("link", "transfer")
+        self.on_transfer(frame)
 
-        performative = TransferPerformative()
-        performative.handle = self._attach.handle
-        performative.delivery_id = UnsignedInt(self._delivery_ids.next())
-        performative.settled = True
+    def on_transfer(self, frame):
+        pass
 
-        tag = "delivery-{}".format(performative.delivery_id).encode("ascii")
-        performative.delivery_tag = tag
+    def send(self, message):
+        self.connection._log_operation("link", "send")
 
-        self.transport.emit_amqp_frame(self.channel, performative, None, message)
+        delivery_id = self._delivery_ids.next()
+        self.transport.emit_transfer_frame(self._transfer_template, delivery_id, None, message)
 
     def close(self, error=None):
         self.connection._log_operation("link", "close")
@@ -17,9 +17,10 @@
 # under the License.
 #
 
+from argon.common import *
 from argon.common import _shorten
 from argon.data import *
-from argon.data import _data_hex, _field, _hex
+from argon.data import _compile_described_list, _data_hex, _field, _get_decoder, _hex
 from argon.message import emit_message
 
 OPEN_DESCRIPTOR = UnsignedLong(0x00000010)
@@ -64,22 +65,59 @@ class AmqpFrame:
         args = name, self.channel, self.performative, _shorten(self.payload, 16)
         return "{}({}, {}, {})".format(*args)
 
+class TransferFrame(AmqpFrame):
+    """
+    A transfer frame with its handle, delivery ID, settled, and more
+    fields read directly from the frame.  The full performative is
+    decoded from the input buffer on first access, so like the payload
+    it is only available until the frame callback returns.  After
+    that, accessing an undecoded performative raises an exception.
+    """
+
+    __slots__ = "handle", "delivery_id", "settled", "more", "_buff", "_performative_offset", "_performative_end", \
+        "_performative", "_decoder"
+
+    def __init__(self, channel, handle, delivery_id, settled, more, payload=None):
+        self.channel = channel
+        self.handle = handle
+        self.delivery_id = delivery_id
+        self.settled = settled
+        self.more = more
+        self.payload = payload
+
+        self._buff = None
+        self._performative_offset = None
+        self._performative_end = None
+        self._performative = None
+        self._decoder = None
+
+    @property
+    def performative(self):
+        if self._performative is None:
+            if self._buff is None:
+                raise Exception("The performative of a transfer frame is not available after its callback")
+
+            self._performative = self._decoder.parse_within(self._buff, self._performative_offset,
+                                                            self._performative_end)[1]
+
+        return self._performative
+
 class OpenPerformative(DescribedValue):
     __slots__ = ()
 
     def __init__(self, values=None):
         super().__init__(OPEN_DESCRIPTOR, values)
 
-    container_id = _field(0, mandatory=True)
-    hostname = _field(1)
-    max_frame_size = _field(2, default=UnsignedInt(0xffffffff))
-    channel_max = _field(3, default=UnsignedShort(0xffff))
-    idle_timeout = _field(4)
+    container_id = _field(0, mandatory=True, type_=str)
+    hostname = _field(1, type_=str)
+    max_frame_size = _field(2, default=UnsignedInt(0xffffffff), type_=UnsignedInt)
+    channel_max = _field(3, default=UnsignedShort(0xffff), type_=UnsignedShort)
+    idle_timeout = _field(4, type_=UnsignedInt)
     outgoing_locales = _field(5)
     incoming_locales = _field(6)
     offered_capabilities = _field(7)
     desired_capabilities = _field(8)
-    properties = _field(9)
+    properties = _field(9, type_=TypedMap(Symbol))
 
 class BeginPerformative(DescribedValue):
     __slots__ = ()
@@ -87,14 +125,14 @@ class BeginPerformative(DescribedValue):
     def __init__(self, values=None):
         super().__init__(BEGIN_DESCRIPTOR, values)
 
-    remote_channel = _field(0)
-    next_outgoing_id = _field(1, mandatory=True)
-    incoming_window = _field(2, mandatory=True)
-    outgoing_window = _field(3, mandatory=True)
-    handle_max = _field(4)
+    remote_channel = _field(0, type_=UnsignedShort)
+    next_outgoing_id = _field(1, mandatory=True, type_=UnsignedInt)
+    incoming_window = _field(2, mandatory=True, type_=UnsignedInt)
+    outgoing_window = _field(3, mandatory=True, type_=UnsignedInt)
+    handle_max = _field(4, type_=UnsignedInt)
     offered_capabilities = _field(5)
     desired_capabilities = _field(6)
-    properties = _field(7)
+    properties = _field(7, type_=TypedMap(Symbol))
 
 class AttachPerformative(DescribedValue):
     __slots__ = ()
@@ -102,20 +140,20 @@ class AttachPerformative(DescribedValue):
     def __init__(self, values=None):
         super().__init__(ATTACH_DESCRIPTOR, values)
 
-    name = _field(0, mandatory=True)
-    handle = _field(1, mandatory=True)
-    role = _field(2, mandatory=True)
-    snd_settle_mode = _field(3, default=UnsignedByte(2)) # Mixed
-    rcv_settle_mode = _field(4, default=UnsignedByte(0)) # First
+    name = _field(0, mandatory=True, type_=str)
+    handle = _field(1, mandatory=True, type_=UnsignedInt)
+    role = _field(2, mandatory=True, type_=bool)
+    snd_settle_mode = _field(3, default=UnsignedByte(2), type_=UnsignedByte) # Mixed
+    rcv_settle_mode = _field(4, default=UnsignedByte(0), type_=UnsignedByte) # First
     source = _field(5)
     target = _field(6)
-    unsettled = _field(7)
-    incoming_unsettled = _field(8, default=False)
-    initial_delivery_count = _field(9)
-    max_message_size = _field(10)
+    unsettled = _field(7, type_=dict)
+    incoming_unsettled = _field(8, default=False, type_=bool)
+    initial_delivery_count = _field(9, type_=UnsignedInt)
+    max_message_size = _field(10, type_=UnsignedLong)
     offered_capabilities = _field(11)
     desired_capabilities = _field(12)
-    properties = _field(13)
+    properties = _field(13, type_=TypedMap(Symbol))
 
 class FlowPerformative(DescribedValue):
     __slots__ = ()
@@ -123,17 +161,17 @@ class FlowPerformative(DescribedValue):
     def __init__(self, values=None):
         super().__init__(FLOW_DESCRIPTOR, values)
 
-    next_incomping_id = _field(0)
-    incoming_window = _field(1, mandatory=True)
-    next_outgoing_id = _field(2, mandatory=True)
-    outgoing_window = _field(3, mandatory=True)
-    handle = _field(4)
-    delivery_count = _field(5)
-    link_credit = _field(6)
-    available = _field(7)
-    drain = _field(8, default=False)
-    echo = _field(9, default=False)
-    properties = _field(10)
+    next_incomping_id = _field(0, type_=UnsignedInt)
+    incoming_window = _field(1, mandatory=True, type_=UnsignedInt)
+    next_outgoing_id = _field(2, mandatory=True, type_=UnsignedInt)
+    outgoing_window = _field(3, mandatory=True, type_=UnsignedInt)
+    handle = _field(4, type_=UnsignedInt)
+    delivery_count = _field(5, type_=UnsignedInt)
+    link_credit = _field(6, type_=UnsignedInt)
+    available = _field(7, type_=UnsignedInt)
+    drain = _field(8, default=False, type_=bool)
+    echo = _field(9, default=False, type_=bool)
+    properties = _field(10, type_=TypedMap(Symbol))
 
 class TransferPerformative(DescribedValue):
     __slots__ = ()
@@ -141,17 +179,17 @@ class TransferPerformative(DescribedValue):
     def __init__(self, values=None):
         super().__init__(TRANSFER_DESCRIPTOR, values)
 
-    handle = _field(0, mandatory=True)
-    delivery_id = _field(1)
-    delivery_tag = _field(2)
-    message_format = _field(3)
-    settled = _field(4)
-    more = _field(5, default=False)
-    rcv_settle_mode = _field(6)
+    handle = _field(0, mandatory=True, type_=UnsignedInt)
+    delivery_id = _field(1, type_=UnsignedInt)
+    delivery_tag = _field(2, type_=bytes)
+    message_format = _field(3, type_=UnsignedInt)
+    settled = _field(4, type_=bool)
+    more = _field(5, default=False, type_=bool)
+    rcv_settle_mode = _field(6, type_=UnsignedByte)
     state = _field(7)
-    resume = _field(8, default=False)
-    aborted = _field(9, default=False)
-    batchable = _field(10, default=False)
+    resume = _field(8, default=False, type_=bool)
+    aborted = _field(9, default=False, type_=bool)
+    batchable = _field(10, default=False, type_=bool)
 
 class DispositionPerformative(DescribedValue):
     __slots__ = ()
@@ -159,24 +197,26 @@ class DispositionPerformative(DescribedValue):
     def __init__(self, values=None):
         super().__init__(DISPOSITION_DESCRIPTOR, values)
 
-    role = _field(0, mandatory=True)
-    first = _field(1, mandatory=True)
-    last = _field(2)
-    settled = _field(3)
+    role = _field(0, mandatory=True, type_=bool)
+    first = _field(1, mandatory=True, type_=UnsignedInt)
+    last = _field(2, type_=UnsignedInt)
+    settled = _field(3, type_=bool)
     batchable = _field(4)
 
 class DetachPerformative(DescribedValue):
     __slots__ = ()
+    _cache_encoding = True
 
     def __init__(self, values=None):
         super().__init__(DETACH_DESCRIPTOR, values)
 
-    handle = _field(0, mandatory=True)
-    closed = _field(1, default=False)
+    handle = _field(0, mandatory=True, type_=UnsignedInt)
+    closed = _field(1, default=False, type_=bool)
     error = _field(2)
 
 class EndPerformative(DescribedValue):
     __slots__ = ()
+    _cache_encoding = True
 
     def __init__(self, values=None):
         super().__init__(END_DESCRIPTOR, values)
@@ -185,6 +225,7 @@ class EndPerformative(DescribedValue):
 
 class ClosePerformative(DescribedValue):
     __slots__ = ()
+    _cache_encoding = True
     descriptor = CLOSE_DESCRIPTOR
 
     def __init__(self, values=None):
@@ -202,45 +243,260 @@ register_value_class(DETACH_DESCRIPTOR, DetachPerformative)
 register_value_class(END_DESCRIPTOR, EndPerformative)
 register_value_class(CLOSE_DESCRIPTOR, ClosePerformative)
 
-def emit_amqp_frame(buff, offset, channel, performative, payload=None, message=None):
+_compile_described_list(OpenPerformative)
+_compile_described_list(BeginPerformative)
+_compile_described_list(AttachPerformative)
+_compile_described_list(FlowPerformative)
+_compile_described_list(TransferPerformative)
+_compile_described_list(DispositionPerformative)
+_compile_described_list(DetachPerformative)
+_compile_described_list(EndPerformative)
+_compile_described_list(ClosePerformative)
+
+def emit_amqp_frame(buff, offset, channel, performative, payload=None, message=None, segments=None,
+                    segment_size=0):
     offset, size_offset = buff.skip(offset, 4)
 
     offset = buff.pack(offset, 4, "!BBH", 2, 0, channel)
     offset = emit_data(buff, offset, performative)
 
+    segment_count = 0 if segments is None else len(segments)
+
+    offset = _emit_frame_payload(buff, offset, payload, message, segments, segment_size)
+
+    size = offset - size_offset + _get_segments_size(segments, segment_count)
+    buff.pack_uint(size_offset, size)
+
+    return offset
+
+# With a segments list, the message body or payload may be left out of
+# buff if it is at least segment_size octets.  See emit_message().
+
+def _emit_frame_payload(buff, offset, payload, message, segments, segment_size):
     if message is not None:
-        offset = emit_message(buff, offset, message)
-    elif payload is not None:
-        offset = buff.write(offset, payload)
+        return emit_message(buff, offset, message, segments, segment_size)
 
-    size = offset - size_offset
-    buff.pack(size_offset, 4, "!I", size)
+    if payload is not None:
+        if segments is not None and len(payload) >= segment_size:
+            segments.append((offset, payload))
+            return offset
+
+        return buff.write(offset, payload)
 
     return offset
 
-def parse_frame(buff, offset):
+def _get_segments_size(segments, start):
+    size = 0
+
+    if segments is not None:
+        for i in range(start, len(segments)):
+            size += len(segments[i][1])
+
+    return size
+
+class TransferTemplate:
+    """
+    The frame header and transfer performative for the messages of
+    one link, encoded once.  emit_transfer_frame() copies it and
+    patches in the delivery ID and a four-octet delivery tag.  Both
+    use fixed-width encodings, so their offsets never move.
+    """
+
+    __slots__ = "octets", "_delivery_id_offset", "_delivery_tag_offset"
+
+    def __init__(self, channel, handle, settled=True):
+        buff = Buffer(32)
+
+        offset = buff.pack(0, 8, "!IBBH", 0, 2, 0, channel)
+        offset = buff.pack(offset, 6, "!BBBBBB", 0x00, 0x53, 0x14, 0xc0, 0, 5)
+        count_offset = offset - 1
+
+        offset = buff.pack(offset, 5, "!BI", 0x70, handle) # Handle
+
+        self._delivery_id_offset = offset + 1
+        offset = buff.pack(offset, 5, "!BI", 0x70, 0) # Delivery ID
+
+        self._delivery_tag_offset = offset + 2
+        offset = buff.pack(offset, 6, "!BBI", 0xa0, 4, 0) # Delivery tag
+
+        offset = buff.pack_ubyte(offset, 0x43) # Message format
+        offset = buff.pack_ubyte(offset, 0x41 if settled else 0x42) # Settled
+
+        buff.pack_ubyte(count_offset - 1, offset - count_offset)
+
+        self.octets = bytes(buff[0:offset])
+
+def emit_transfer_frame(buff, offset, template, delivery_id, payload=None, message=None, segments=None,
+                        segment_size=0):
+    start = offset
+    delivery_id &= 0xffffffff
+
+    offset = buff.write(offset, template.octets)
+
+    buff.pack_uint(start + template._delivery_id_offset, delivery_id)
+    buff.pack_uint(start + template._delivery_tag_offset, delivery_id)
+
+    segment_count = 0 if segments is None else len(segments)
+
+    offset = _emit_frame_payload(buff, offset, payload, message, segments, segment_size)
+
+    buff.pack_uint(start, offset - start + _get_segments_size(segments, segment_count))
+
+    return offset
+
+def parse_frame(buff, offset, decoder=None):
     start = offset
     offset, size, channel = parse_frame_header(buff, offset)
     end = start + size
 
-    return parse_frame_body(buff, offset, end, channel)
+    return parse_frame_body(buff, offset, end, channel, decoder)
 
 def parse_frame_header(buff, offset):
-    offset, size, _, _, channel = buff.unpack(offset, 8, "!IBBH")
-    return offset, size, channel
+    size = buff.unpack_uint(offset)
+    channel = buff.unpack_ushort(offset + 6)
+
+    return offset + 8, size, channel
 
-def parse_frame_body(buff, offset, end, channel):
-    offset, performative = parse_data(buff, offset)
+def parse_frame_body(buff, offset, end, channel, decoder=None):
+    if decoder is None:
+        decoder = _get_decoder()
+
+    if end - offset >= 4 and buff.unpack_ubyte(offset + 2) == 0x14 \
+            and buff.unpack_ubyte(offset) == 0x00 and buff.unpack_ubyte(offset + 1) == 0x53:
+        frame = _parse_transfer_frame_body(buff, offset, end, channel, decoder)
+
+        if frame is not None:
+            return end, frame
+
+    offset, performative = decoder.parse_within(buff, offset, end)
 
     assert isinstance(performative, DescribedValue)
 
-    if end == offset:
-        return offset, AmqpFrame(channel, performative)
+    payload = None
+
+    if end != offset:
+        offset, payload = buff.read(offset, end - offset)
+
+    if type(performative) is TransferPerformative:
+        frame = TransferFrame(channel, performative.handle, performative.delivery_id,
+                              performative.settled, performative.more, payload)
+        frame._performative = performative
 
-    offset, payload = buff.read(offset, end - offset)
+        return offset, frame
 
     return offset, AmqpFrame(channel, performative, payload)
 
+# Reads the first fields of a transfer performative in its common
+# encodings.  Returns None for anything else, and the caller falls
+# back to decoding the whole performative.
+
+def _parse_transfer_frame_body(buff, offset, end, channel, decoder):
+    start = offset
+    offset += 3
+    format_code = buff.unpack_ubyte(offset)
+
+    if format_code == 0xc0:
+        performative_end = offset + 2 + buff.unpack_ubyte(offset + 1)
+        count = buff.unpack_ubyte(offset + 2)
+        offset += 3
+    elif format_code == 0xd0:
+        performative_end = offset + 5 + buff.unpack_uint(offset + 1)
+        count = buff.unpack_uint(offset + 5)
+        offset += 9
+    else:
+        return None
+
+    if performative_end > end:
+        return None
+
+    handle = delivery_id = settled = None
+    more = False
+
+    if count > 0:
+        offset, handle = _parse_transfer_uint(buff, offset)
+
+    if count > 1 and offset >= 0:
+        offset, delivery_id = _parse_transfer_uint(buff, offset)
+
+    if count > 4 and offset >= 0:
+        offset = skip_data(buff, skip_data(buff, offset))
+        offset, settled = _parse_transfer_boolean(buff, offset)
+
+    if count > 5 and offset >= 0:
+        offset, more = _parse_transfer_boolean(buff, offset)
+
+        if more is None:
+            more = False
+
+    if offset < 0 or offset > performative_end or handle is None:
+        return None
+
+    payload = None
+
+    if end != performative_end:
+        payload = buff.read(performative_end, end - performative_end)[1]
+
+    if _free_transfer_frames:
+        frame = _free_transfer_frames.pop()
+        frame.__init__(channel, handle, delivery_id, settled, more, payload)
+    else:
+        frame = TransferFrame(channel, handle, delivery_id, settled, more, payload)
+
+    frame._buff = buff
+    frame._performative_offset = start
+    frame._performative_end = performative_end
+    frame._decoder = decoder
+
+    return frame
+
+# Transfer frames handed back by a transport once it is done with them.
+# They are reused by the fast path.
+
+_free_transfer_frames = list()
+_free_transfer_frames_max = 16
+
+def _release_transfer_frame(frame):
+    if len(_free_transfer_frames) < _free_transfer_frames_max:
+        frame.payload = None
+        frame._buff = None
+        frame._performative = None
+
+        _free_transfer_frames.append(frame)
+
+def _parse_transfer_uint(buff, offset):
+    format_code = buff.unpack_ubyte(offset)
+
+    if format_code == 0x52:
+        return offset + 2, buff.unpack_ubyte(offset + 1)
+
+    if format_code == 0x70:
+        return offset + 5, buff.unpack_uint(offset + 1)
+
+    if format_code == 0x43:
+        return offset + 1, 0
+
+    if format_code == 0x40:
+        return offset + 1, None
+
+    return -1, None
+
+def _parse_transfer_boolean(buff, offset):
+    format_code = buff.unpack_ubyte(offset)
+
+    if format_code == 0x41:
+        return offset + 1, True
+
+    if format_code == 0x42:
+        return offset + 1, False
+
+    if format_code == 0x40:
+        return offset + 1, None
+
+    if format_code == 0x56:
+        return offset + 2, buff.unpack_ubyte(offset + 1) == 0x01
+
+    return -1, None
+
 def _frame_hex(octets):
     o = _hex(octets)
     args = o[0:8], o[8:12], o[12:16], o[16:18], o[18:22], o[22:24], o[24:]
@@ -35,9 +35,94 @@ _input_frames = [
     AmqpFrame(0, ClosePerformative()),
 ]
 
+def _check_limits():
+    # Described lists parsed by the compiled performative parsers count
+    # toward max_depth like any other list
+    value = None
+
+    for i in range(50):
+        value = ClosePerformative([value])
+
+    buff = Buffer()
+    emit_data(buff, 0, value)
+
+    assert Decoder().parse(buff, 0)[1] == value
+
+    try:
+        Decoder(max_depth=8).parse(buff, 0)
+    except Exception as e:
+        assert "Nesting exceeds" in str(e), str(e)
+    else:
+        assert False, "Expected a limit error"
+
+def _check_equality():
+    # Trailing nulls are unset fields in a performative but values in
+    # other described lists
+    assert OpenPerformative(["x"]) == OpenPerformative(["x", None, None])
+    assert DescribedValue(Symbol("x"), [1]) != DescribedValue(Symbol("x"), [1, None])
+
+def _check_transfer_frames():
+    # The fields read by the transfer fast path match a full decode of
+    # the performative, with the default decoder and a raw one
+    performatives = list()
+
+    for handle in (0, 1, 300, 0xffffffff):
+        for delivery_id in (None, 0, 200, 0x10000):
+            for settled in (None, True, False):
+                for more in (False, True):
+                    performative = TransferPerformative()
+                    performative.handle = handle
+                    performative.delivery_id = delivery_id
+                    performative.delivery_tag = b"tag"
+                    performative.message_format = 0
+                    performative.settled = settled
+                    performative.more = more
+
+                    performatives.append(performative)
+
+    # A long delivery tag forces the long list encoding
+    performative = TransferPerformative([1, 2, b"x" * 300, 0, True, True])
+    performatives.append(performative)
+
+    template = TransferTemplate(1, 7, settled=False)
+
+    for decoder in (Decoder(), Decoder(raw=True)):
+        for performative in performatives:
+            buff = Buffer()
+            end = emit_amqp_frame(buff, 0, 1, performative, b"payload")
+
+            offset, frame = parse_frame(buff, 0, decoder)
+
+            assert offset == end
+            assert type(frame) is TransferFrame, performative
+            assert bytes(frame.payload) == b"payload"
+
+            fields = frame.handle, frame.delivery_id, frame.settled, frame.more
+            expected = performative.handle, performative.delivery_id, performative.settled, performative.more
+            decoded = frame.performative
+
+            assert fields == expected, (fields, expected)
+            assert (decoded.handle, decoded.delivery_id, decoded.settled, decoded.more) == expected
+            assert decoded == performative
+
+        for delivery_id in (0, 1, 0xffffffff):
+            buff = Buffer()
+            end = emit_transfer_frame(buff, 0, template, delivery_id, b"payload")
+
+            offset, frame = parse_frame(buff, 0, decoder)
+            decoded = frame.performative
+
+            assert offset == end and frame.channel == 1
+            assert (frame.handle, frame.delivery_id, frame.settled, frame.more) == (7, delivery_id, False, False)
+            assert (decoded.handle, decoded.delivery_id, decoded.settled, decoded.more) == (7, delivery_id, False, False)
+
 def _main():
     debug = True
 
+    _check_limits()
+    _check_equality()
+    _check_transfer_frames()
+
     buff = Buffer()
     offset = 0
 
@@ -18,7 +18,7 @@
 #
 
 from argon.data import *
-from argon.data import _field
+from argon.data import _compile_described_list, _emit_descriptor, _field
 
 _HEADER_DESCRIPTOR = UnsignedLong(0x00000070)
 _DELIVERY_ANNOTATIONS_DESCRIPTOR = UnsignedLong(0x00000071)
@@ -34,11 +34,11 @@ class _Header(DescribedValue):
     def __init__(self, value=None):
         super().__init__(_HEADER_DESCRIPTOR, value)
 
-    durable = _field(0, default=False)
-    priority = _field(1, default=UnsignedByte(4))
-    ttl = _field(2)
-    first_acquirer = _field(3, default=False)
-    delivery_count = _field(4, default=UnsignedInt(0))
+    durable = _field(0, default=False, type_=bool)
+    priority = _field(1, default=UnsignedByte(4), type_=UnsignedByte)
+    ttl = _field(2, type_=UnsignedInt)
+    first_acquirer = _field(3, default=False, type_=bool)
+    delivery_count = _field(4, default=UnsignedInt(0), type_=UnsignedInt)
 
 class _Attributes(DescribedValue):
     __slots__ = ()
@@ -51,12 +51,14 @@ class _Attributes(DescribedValue):
 
 class _DeliveryAnnotations(_Attributes):
     __slots__ = ()
+    _value_type = TypedMap(Symbol)
 
     def __init__(self, value=None):
         super().__init__(_DELIVERY_ANNOTATIONS_DESCRIPTOR, value)
 
 class _MessageAnnotations(_Attributes):
     __slots__ = ()
+    _value_type = TypedMap(Symbol)
 
     def __init__(self, value=None):
         super().__init__(_MESSAGE_ANNOTATIONS_DESCRIPTOR, value)
@@ -68,18 +70,24 @@ class _Properties(DescribedValue):
         super().__init__(_PROPERTIES_DESCRIPTOR, value)
 
     message_id = _field(0)
-    user_id = _field(1)
-    to = _field(2)
-    subject = _field(3)
-    reply_to = _field(4)
+    user_id = _field(1, type_=bytes)
+    to = _field(2, type_=str)
+    subject = _field(3, type_=str)
+    reply_to = _field(4, type_=str)
     correlation_id = _field(5)
-    content_type = _field(6)
-    content_encoding = _field(7)
-    absolute_expiry_time = _field(8)
-    creation_time = _field(9)
-    group_id = _field(10)
-    group_sequence = _field(11)
-    reply_to_group_id = _field(12)
+    content_type = _field(6, type_=Symbol)
+    content_encoding = _field(7, type_=Symbol)
+    absolute_expiry_time = _field(8, type_=Timestamp)
+    creation_time = _field(9, type_=Timestamp)
+    group_id = _field(10, type_=str)
+    group_sequence = _field(11, type_=UnsignedInt)
+    reply_to_group_id = _field(12, type_=str)
+
+register_value_class(_HEADER_DESCRIPTOR, _Header)
+register_value_class(_PROPERTIES_DESCRIPTOR, _Properties)
+
+_compile_described_list(_Header)
+_compile_described_list(_Properties)
 
 class _ApplicationProperties(_Attributes):
     __slots__ = ()
@@ -95,6 +103,7 @@ class _AmqpValue(DescribedValue):
 
 class _Footer(_Attributes):
     __slots__ = ()
+    _value_type = TypedMap(Symbol)
 
     def __init__(self, value=None):
         super().__init__(_FOOTER_DESCRIPTOR, value)
@@ -198,7 +207,7 @@ class Message:
 
         return self._footer._value
 
-    def _emit(self, buff, offset):
+    def _emit(self, buff, offset, segments=None, segment_size=0):
         if self._header is not None:
             offset = emit_data(buff, offset, self._header)
 
@@ -215,12 +224,35 @@ class Message:
             offset = emit_data(buff, offset, self._application_properties)
 
         if self._application_data is not None:
-            offset = emit_data(buff, offset, self._application_data)
+            offset = _emit_application_data(buff, offset, self._application_data, segments, segment_size)
 
         if self._footer is not None:
             offset = emit_data(buff, offset, self._footer)
 
         return offset
 
-def emit_message(buff, offset, message):
-    return message._emit(buff, offset)
+def _emit_application_data(buff, offset, section, segments, segment_size):
+    value = section._value
+
+    if segments is None or type(value) not in (bytes, bytearray) or len(value) < segment_size:
+        return emit_data(buff, offset, section)
+
+    # Encode the section up to the octets of the body and leave the
+    # body itself for the caller to send after them
+    offset = buff.pack_ubyte(offset, 0x00)
+    offset = _emit_descriptor(buff, offset, section._descriptor)
+    offset = buff.pack(offset, 5, "!BI", 0xb0, len(value))
+
+    segments.append((offset, value))
+
+    return offset
+
+def emit_message(buff, offset, message, segments=None, segment_size=0):
+    """
+    With a segments list, a binary body at least segment_size octets
+    long is not copied into buff.  A (offset, octets) pair is added to
+    segments instead, saying that the octets belong after the first
+    offset octets of buff.
+    """
+
+    return message._emit(buff, offset, segments, segment_size)
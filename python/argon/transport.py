@@ -20,22 +20,106 @@
 import sys as _sys
 
 from argon.common import *
-from argon.common import _DEBUG, _micropython, _time, _select, _socket, _struct
+from argon.common import _DEBUG, _heapq, _micropython, _time, _select, _socket, _struct
 from argon.frames import *
-from argon.frames import _frame_hex, _hex
+from argon.frames import _frame_hex, _hex, _release_transfer_frame
+
+# Kept under the IOV_MAX of common systems
+_max_write_parts = 512
+
+if _micropython:
+    _ticks_ms = _time.ticks_ms
+    _ticks_add = _time.ticks_add
+    _ticks_diff = _time.ticks_diff
+else:
+    def _ticks_ms():
+        return int(_time.monotonic() * 1000)
+
+    def _ticks_add(ticks, delta):
+        return ticks + delta
+
+    def _ticks_diff(end, start):
+        return end - start
 
 class SocketTransport:
+    # Buffers that grew past this while draining a burst are cut back
+    # once they are empty again
+    buffer_shrink_size = 64 * 1024
+
+    # Shared by all transports unless replaced on a subclass or instance
+    buffer_pool = BufferPool()
+
+    # Set to hand received transfer frames back for reuse once
+    # on_frame returns.  The frames must not be kept past that point.
+    reuse_transfer_frames = False
+
+    # Each read asks for all the free space in the input buffer, and at
+    # least read_size octets, so reads grow along with the buffer.  Set
+    # drain_reads to keep reading on each POLLIN until the socket is
+    # empty or max_drain_size octets have come in.
+    read_size = 512 if _micropython else 16 * 1024
+    drain_reads = False
+    max_drain_size = 1024 * 1024
+
+    # Message bodies and payloads at least this large are sent straight
+    # from the caller's octets with sendmsg, not copied into the output
+    # buffer.  They must not change until they are sent.  Without
+    # sendmsg, as on MicroPython, they are always copied.
+    segment_size = 64 * 1024 if hasattr(_socket.socket, "sendmsg") else None
+
+    # Output is written as soon as the socket takes it unless
+    # flush_delay is set.  Then it is held for up to flush_delay
+    # milliseconds, or until flush_size octets are waiting, so that
+    # small frames go out together.  cork() holds output regardless.
+    flush_delay = 0
+    flush_size = 16 * 1024
+
+    # Set tcp_nodelay to True or False to change TCP_NODELAY on
+    # connect.  With tcp_cork set, cork() uses TCP_CORK, where the
+    # system has it, and the kernel holds the output instead.
+    tcp_nodelay = None
+    tcp_cork = False
+
     def __init__(self, socket, address):
         self.socket = socket
         self.address = address
         self.debug = _DEBUG
 
-        self._input_buffer = Buffer()
-        self._output_buffer = Buffer()
+        # Replace with, for instance, Decoder(raw=True) to change how
+        # this connection decodes frames.  Each transport has its own
+        # decoder, so transports in different threads do not share
+        # parse state.
+        self.decoder = Decoder()
+
+        self._input_buffer = self.buffer_pool.checkout(shrink_size=self.buffer_shrink_size)
+        self._output_buffer = self.buffer_pool.checkout(shrink_size=self.buffer_shrink_size)
+
+        self._read_offset = 0
+        self._parse_offset = 0
         self._emit_offset = 0
+        self._write_offset = 0
+
+        # (offset, octets) pairs for octets to be sent after the output
+        # buffer is written up to offset
+        self._output_segments = list()
+
+        self._flush_deadline = None
+        self._cork_count = 0
+        self._tcp_corked = False
 
         self._stopping = False
 
+        # Set while the transport is run by a Reactor
+        self._reactor = None
+        self._poll_key = None
+        self._poll_events = None
+        self._timer_deadline = None
+
+        self.read_count = 0
+        self.read_octets = 0
+        self.frame_count = 0
+        self.compact_count = 0
+
     def _log_output(self, octets, frame, message=None):
         if self.debug:
             print("S", octets)
@@ -47,70 +131,175 @@ class SocketTransport:
             print(" ", frame)
 
     def run(self):
-        read_offset = 0
-        parse_offset = 0
-        write_offset = 0
-
         try:
-            self.socket.connect(self.address)
-
-            self._shake_hands()
-
-            self.socket.setblocking(False)
-
-            self.on_start()
+            self._start()
 
             poller = _select.poll()
-            poller.register(self.socket)
+            poller.register(self.socket, self._get_poll_events())
 
             while not self._stopping:
-                events = poller.poll(1000)
+                events = poller.poll(self._get_poll_timeout())
 
+                # A timeout may mean held output is due, so the events
+                # are handled either way
                 if len(events) == 0:
-                    continue
+                    self._handle_events(0)
+                else:
+                    self._handle_events(events[0][1])
+
+                poller.modify(self.socket, self._get_poll_events())
+
+            self.on_stop(None) # XXX Error
+        finally:
+            self._close()
 
-                flags = events[0][1]
+    def _start(self):
+        self.socket.connect(self.address)
 
-                if self.debug:
-                    print("T buff", "input", len(self._input_buffer), "output", len(self._output_buffer))
-                    print("  offs", "read", read_offset, "parse", parse_offset, "emit", self._emit_offset, "write", write_offset)
-                    print("  poll", (flags & _select.POLLIN and "IN " or "---"), (flags & _select.POLLOUT and "OUT" or "---"))
+        self._shake_hands()
 
-                if flags & _select.POLLERR:
-                    raise Exception("POLLERR!")
+        self.socket.setblocking(False)
 
-                if flags & _select.POLLHUP:
-                    raise Exception("POLLHUP!")
+        if self.tcp_nodelay is not None and hasattr(_socket, "TCP_NODELAY"):
+            self.socket.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, int(self.tcp_nodelay))
 
-                if flags & _select.POLLOUT:
-                    write_offset = self._write_socket(write_offset, self._emit_offset)
+        self.on_start()
 
-                if flags & _select.POLLIN:
-                    read_offset = self._read_socket(read_offset)
+    def _close(self):
+        self.socket.close()
 
-                parse_offset = self._parse_frames(parse_offset, read_offset)
+        self.buffer_pool.checkin(self._input_buffer)
+        self.buffer_pool.checkin(self._output_buffer)
 
-                if parse_offset == read_offset:
-                    read_offset = 0
-                    parse_offset = 0
+        self._input_buffer = None
+        self._output_buffer = None
 
-                if write_offset < self._emit_offset:
-                    poller.modify(self.socket, _select.POLLIN | _select.POLLOUT)
-                else:
-                    if self._emit_offset == write_offset:
-                        self._emit_offset = 0
-                        write_offset = 0
+    def _handle_events(self, flags):
+        if self.debug and flags:
+            print("T buff", "input", len(self._input_buffer), "output", len(self._output_buffer))
+            print("  offs", "read", self._read_offset, "parse", self._parse_offset, "emit", self._emit_offset, "write", self._write_offset)
+            print("  poll", (flags & _select.POLLIN and "IN " or "---"), (flags & _select.POLLOUT and "OUT" or "---"))
 
-                    poller.modify(self.socket, _select.POLLIN)
+        if flags & _select.POLLERR:
+            raise Exception("POLLERR!")
 
-            self.on_stop(None) # XXX Error
-        finally:
-            self.socket.close()
+        if flags & _select.POLLHUP:
+            raise Exception("POLLHUP!")
+
+        if flags & _select.POLLOUT:
+            self._write_offset = self._write_socket(self._write_offset, self._emit_offset)
+
+        if flags & _select.POLLIN:
+            self._read_offset = self._read_socket(self._read_offset)
+
+        read_offset = self._read_offset
+        parse_offset = self._parse_frames(self._parse_offset, read_offset)
+
+        if parse_offset == read_offset:
+            read_offset = 0
+            parse_offset = 0
+
+            self._input_buffer.shrink(0)
+        elif parse_offset > len(self._input_buffer) // 2:
+            # Under steady load there is usually a partial frame
+            # pending, so the offsets never reset.  Move it to the
+            # front instead of letting the buffer grow.  This is safe
+            # because frame views are not used past on_frame.
+            read_offset = self._input_buffer.compact(parse_offset, read_offset)
+            parse_offset = 0
+
+            self._input_buffer.shrink(read_offset)
+            self.compact_count += 1
+
+        self._read_offset = read_offset
+        self._parse_offset = parse_offset
+
+        if self._write_offset == self._emit_offset and not self._output_segments:
+            self._emit_offset = 0
+            self._write_offset = 0
+            self._flush_deadline = None
+
+            self._output_buffer.shrink(0)
+
+    def _get_poll_events(self):
+        if (self._write_offset < self._emit_offset or self._output_segments) and self._is_flush_due():
+            return _select.POLLIN | _select.POLLOUT
+
+        return _select.POLLIN
 
     def stop(self):
         assert self._stopping is False
         self._stopping = True
 
+        if self._reactor is not None:
+            self._reactor._refresh(self)
+
+    def cork(self):
+        """
+        Holds output until the matching uncork(), so a burst of frames
+        is written together.  Calls may nest.
+        """
+
+        self._cork_count += 1
+
+        if self._cork_count == 1 and self.tcp_cork and hasattr(_socket, "TCP_CORK"):
+            self.socket.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_CORK, 1)
+            self._tcp_corked = True
+
+    def uncork(self):
+        assert self._cork_count > 0
+        self._cork_count -= 1
+
+        if self._cork_count == 0:
+            # Write what was held without waiting for flush_delay
+            self._flush_deadline = _ticks_ms()
+
+            if self._tcp_corked:
+                self.socket.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_CORK, 0)
+                self._tcp_corked = False
+
+            if self._reactor is not None:
+                self._reactor._refresh(self)
+
+    def _is_flush_due(self):
+        if self._cork_count and not self._tcp_corked:
+            return False
+
+        if not self.flush_delay or self._flush_deadline is None or self._output_segments:
+            return True
+
+        now = _ticks_ms()
+
+        if self._emit_offset - self._write_offset >= self.flush_size:
+            # Keep writing until the output is all out
+            self._flush_deadline = now
+
+        return _ticks_diff(self._flush_deadline, now) <= 0
+
+    def _get_poll_timeout(self):
+        # Wake up in time to write output held by flush_delay
+        if self._flush_deadline is None or self._cork_count:
+            return 1000
+
+        return max(0, min(1000, _ticks_diff(self._flush_deadline, _ticks_ms())))
+
+    def _on_output(self):
+        if self.flush_delay and self._flush_deadline is None:
+            self._flush_deadline = _ticks_add(_ticks_ms(), self.flush_delay)
+
+        if self._reactor is not None:
+            self._reactor._refresh(self)
+
+    def stats(self):
+        return {
+            "read_count": self.read_count,
+            "read_octets": self.read_octets,
+            "frame_count": self.frame_count,
+            "compact_count": self.compact_count,
+            "octets_per_read": self.read_octets / max(1, self.read_count),
+            "reads_per_frame": self.read_count / max(1, self.frame_count),
+        }
+
     def on_start(self):
         pass
 
@@ -120,15 +309,37 @@ class SocketTransport:
     def on_stop(self, error):
         pass
 
+    def _get_segments(self):
+        # Frames are logged from the output buffer, so nothing is left
+        # out of it when debugging
+        if self.segment_size is None or self.debug:
+            return None
+
+        return self._output_segments
+
     def emit_amqp_frame(self, channel, performative, payload=None, message=None):
         start = self._emit_offset
-        offset = emit_amqp_frame(self._output_buffer, start, channel, performative, payload, message)
+        offset = emit_amqp_frame(self._output_buffer, start, channel, performative, payload, message,
+                                 self._get_segments(), self.segment_size)
 
         if self.debug:
             frame = AmqpFrame(channel, performative, payload)
             self._log_output(_frame_hex(self._output_buffer[start:offset]), frame, message)
 
         self._emit_offset = offset
+        self._on_output()
+
+    def emit_transfer_frame(self, template, delivery_id, payload=None, message=None):
+        start = self._emit_offset
+        offset = emit_transfer_frame(self._output_buffer, start, template, delivery_id, payload, message,
+                                     self._get_segments(), self.segment_size)
+
+        if self.debug:
+            frame = parse_frame(self._output_buffer, start)[1]
+            self._log_output(_frame_hex(self._output_buffer[start:offset]), frame, message)
+
+        self._emit_offset = offset
+        self._on_output()
 
     def _shake_hands(self):
         protocol_header = _struct.pack("!4sBBBB", b"AMQP", 0, 1, 0, 0)
@@ -150,24 +361,95 @@ class SocketTransport:
 
         assert response == protocol_header
 
+    def _read_socket(self, offset):
+        buff = self._input_buffer
+        limit = offset + self.max_drain_size
+
+        while True:
+            buff.ensure(offset + self.read_size)
+            size = len(buff) - offset
+
+            count = self._receive(buff[offset:], size)
+
+            # None if the socket would block
+            if count is None:
+                break
+
+            if count == 0:
+                raise Exception("Connection closed")
+
+            self.read_count += 1
+            self.read_octets += count
+
+            offset += count
+
+            # A short read means the socket is empty for now
+            if not self.drain_reads or count < size or offset >= limit:
+                break
+
+        return offset
+
     if _micropython:
-        def _read_socket(self, offset):
-            start = offset
-            self._input_buffer.ensure(offset + 64)
-            return offset + self.socket.readinto(self._input_buffer[offset:], 64)
+        def _receive(self, view, size):
+            return self.socket.readinto(view, size)
 
         def _write_socket(self, write_offset, emit_offset):
             octets = bytes(self._output_buffer[write_offset:emit_offset])
             return write_offset + self.socket.send(octets)
     else:
-        def _read_socket(self, offset):
-            start = offset
-            self._input_buffer.ensure(offset + 64)
-            return offset + self.socket.recv_into(self._input_buffer[offset:], 64)
+        def _receive(self, view, size):
+            try:
+                return self.socket.recv_into(view, size)
+            except BlockingIOError:
+                return None
 
         def _write_socket(self, write_offset, emit_offset):
-            octets = self._output_buffer[write_offset:emit_offset]
-            return write_offset + self.socket.send(octets)
+            segments = self._output_segments
+
+            if not segments:
+                octets = self._output_buffer[write_offset:emit_offset]
+                return write_offset + self.socket.send(octets)
+
+            # Gather the buffer octets and the segments between them
+            buff = self._output_buffer
+            parts = list()
+            offset = write_offset
+
+            for segment_offset, octets in segments[:_max_write_parts // 2]:
+                if offset < segment_offset:
+                    parts.append(buff[offset:segment_offset])
+
+                parts.append(octets)
+                offset = segment_offset
+
+            if len(segments) <= _max_write_parts // 2 and offset < emit_offset:
+                parts.append(buff[offset:emit_offset])
+
+            sent = self.socket.sendmsg(parts)
+
+            # Step through the buffer and the segments by the octets sent
+            while True:
+                if segments and segments[0][0] == write_offset:
+                    segment_offset, octets = segments[0]
+
+                    if sent < len(octets):
+                        if sent:
+                            segments[0] = segment_offset, memoryview(octets)[sent:]
+
+                        break
+
+                    sent -= len(octets)
+                    del segments[0]
+                elif sent:
+                    limit = segments[0][0] if segments else emit_offset
+                    size = min(sent, limit - write_offset)
+
+                    write_offset += size
+                    sent -= size
+                else:
+                    break
+
+            return write_offset
 
     def _parse_frames(self, offset, limit):
         while offset < limit:
@@ -182,12 +464,27 @@ class SocketTransport:
             if end > limit:
                 return start
 
-            offset, frame = parse_frame_body(self._input_buffer, offset, end, channel)
+            offset, frame = parse_frame_body(self._input_buffer, offset, end, channel, self.decoder)
+            self.frame_count += 1
 
-            self._log_input(_frame_hex(self._input_buffer[start:offset]), frame)
+            if self.debug:
+                self._log_input(_frame_hex(self._input_buffer[start:offset]), frame)
 
+            # The frame payload, and any values decoded from it
+            # without copying, refer to the input buffer.  The buffer
+            # is reused once all received octets are parsed, so they
+            # are valid only until on_frame returns.
             self.on_frame(frame)
 
+            # Detach the input buffer so that a transfer frame kept
+            # past on_frame raises on access to its performative
+            # instead of decoding whatever the buffer holds next
+            if type(frame) is TransferFrame:
+                frame._buff = None
+
+                if self.reuse_transfer_frames:
+                    _release_transfer_frame(frame)
+
         return offset
 
 class TcpTransport(SocketTransport):
@@ -199,3 +496,162 @@ class TcpTransport(SocketTransport):
         address = _socket.getaddrinfo(self.host, self.port)[0][-1]
 
         super().__init__(socket, address)
+
+if hasattr(_select, "epoll"):
+    class _Poller:
+        # The poll interface over epoll, with timeouts in milliseconds
+
+        def __init__(self):
+            self._epoll = _select.epoll()
+
+        def register(self, socket, events):
+            self._epoll.register(socket.fileno(), events)
+
+        def modify(self, socket, events):
+            self._epoll.modify(socket.fileno(), events)
+
+        def unregister(self, socket):
+            self._epoll.unregister(socket.fileno())
+
+        def poll(self, timeout):
+            return self._epoll.poll(timeout / 1000)
+else:
+    _Poller = _select.poll
+
+class Reactor:
+    """
+    Runs many transports on one poller in one thread.  add() connects
+    a transport and hands it to the reactor in place of its own run().
+    run() returns once stop() is called or no transports are left.
+
+    Timers from schedule() share one heap with the flush deadlines of
+    the transports.  Delays are in milliseconds.
+    """
+
+    def __init__(self):
+        self._poller = _Poller()
+        self._transports_by_key = dict()
+        self._changed_transports = set()
+        self._timers = list()
+        self._timer_sequence = 0
+        self._stopping = False
+
+    def add(self, transport):
+        assert transport._reactor is None
+
+        try:
+            transport._start()
+        except:
+            transport._close()
+            raise
+
+        # MicroPython's poll reports the socket itself
+        if _micropython:
+            key = transport.socket
+        else:
+            key = transport.socket.fileno()
+
+        transport._reactor = self
+        transport._poll_key = key
+        transport._poll_events = transport._get_poll_events()
+
+        self._poller.register(transport.socket, transport._poll_events)
+        self._transports_by_key[key] = transport
+
+        self._schedule_flush(transport)
+
+    def schedule(self, delay, function):
+        self._push_timer(_ticks_add(_ticks_ms(), delay), function)
+
+    def stop(self):
+        self._stopping = True
+
+    def run(self):
+        poller = self._poller
+        transports_by_key = self._transports_by_key
+
+        try:
+            while not self._stopping and transports_by_key:
+                for key, flags in poller.poll(self._get_poll_timeout()):
+                    transport = transports_by_key.get(key)
+
+                    if transport is None:
+                        continue
+
+                    try:
+                        transport._handle_events(flags)
+                    except Exception as e:
+                        self._remove(transport, e)
+                        continue
+
+                    self._changed_transports.add(transport)
+
+                self._run_timers()
+                self._update_transports()
+        finally:
+            for transport in list(transports_by_key.values()):
+                self._remove(transport, None)
+
+    def _refresh(self, transport):
+        self._changed_transports.add(transport)
+
+    def _update_transports(self):
+        # Frames emitted from any callback can change what a transport
+        # waits for, so the changed ones are checked after each round
+        while self._changed_transports:
+            transport = self._changed_transports.pop()
+
+            if transport._reactor is not self:
+                continue
+
+            if transport._stopping:
+                self._remove(transport, None)
+                continue
+
+            events = transport._get_poll_events()
+
+            if events != transport._poll_events:
+                self._poller.modify(transport.socket, events)
+                transport._poll_events = events
+
+            self._schedule_flush(transport)
+
+    def _schedule_flush(self, transport):
+        deadline = transport._flush_deadline
+
+        if deadline is None or deadline == transport._timer_deadline or transport._poll_events & _select.POLLOUT:
+            return
+
+        transport._timer_deadline = deadline
+        self._push_timer(deadline, lambda: self._refresh(transport))
+
+    def _remove(self, transport, error):
+        del self._transports_by_key[transport._poll_key]
+        self._poller.unregister(transport.socket)
+
+        transport._reactor = None
+
+        try:
+            transport.on_stop(error)
+        finally:
+            transport._close()
+
+    def _push_timer(self, deadline, function):
+        self._timer_sequence += 1
+        _heapq.heappush(self._timers, (deadline, self._timer_sequence, function))
+
+    def _run_timers(self):
+        timers = self._timers
+        now = _ticks_ms()
+
+        while timers and _ticks_diff(timers[0][0], now) <= 0:
+            _heapq.heappop(timers)[2]()
+
+    def _get_poll_timeout(self):
+        if self._changed_transports:
+            return 0
+
+        if not self._timers:
+            return 1000
+
+        return max(0, min(1000, _ticks_diff(self._timers[0][0], _ticks_ms())))